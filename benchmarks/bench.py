@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""Headless benchmarks for rsync-ssh.
+
+Drives the sync engine in rsync_ssh_core directly, with benchmarks/fake_ssh.py as ssh_binary so "remote"
+commands run locally, and the local rsync for the actual transfers.
+
+    python3 benchmarks/bench.py
+    python3 benchmarks/bench.py --sizes 1000,10000,100000 --destinations 1,4,8 --bursts 1,10,40
+
+Scenarios:
+- resolution: time to resolve a saved path to its destinations
+- dispatch:   time to queue and dispatch a burst of saves, without running rsync
+- save:       save to synced latency for a burst of saves (requires rsync)
+- full:       full sync throughput (requires rsync)
+- agent:      save to synced latency using the receiver agent, over a loopback "ssh"
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import rsync_ssh_core.engine  # noqa: E402 pylint: disable=C0413
+from rsync_ssh_core import Config, Reporter, SyncEngine  # noqa: E402 pylint: disable=C0413
+from rsync_ssh_core.agent import AgentClient  # noqa: E402 pylint: disable=C0413
+from rsync_ssh_core.index import RemoteIndex  # noqa: E402 pylint: disable=C0413
+from rsync_ssh_core.job import Rsync  # noqa: E402 pylint: disable=C0413
+
+FAKE_SSH = os.path.join(BENCHMARK_DIR, "fake_ssh.py")
+
+
+class SpawnCounter(object):
+    """Count processes started by the plugin, by wrapping subprocess.Popen"""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+        self.popen = original = subprocess.Popen
+        counter = self
+
+        class CountingPopen(original):  # pylint: disable=R0903
+            def __init__(self, *args, **kwargs):
+                with counter.lock:
+                    counter.count += 1
+                # subprocess.Popen is this class while counting
+                original.__init__(self, *args, **kwargs)
+
+        self.counting_popen = CountingPopen
+
+    def __enter__(self):
+        self.count = 0
+        subprocess.Popen = self.counting_popen
+        return self
+
+    def __exit__(self, *args):
+        subprocess.Popen = self.popen
+
+
+def make_tree(root, files, file_size=1024, files_per_dir=100):
+    """Create tree with files spread over directories, returns list of file paths"""
+    paths = []
+    data = os.urandom(file_size)
+    for number in range(files):
+        directory = os.path.join(root, "d" + str(number // files_per_dir))
+        if number % files_per_dir == 0:
+            os.makedirs(directory)
+        path = os.path.join(directory, "f" + str(number) + ".txt")
+        with open(path, "wb") as file:
+            file.write(data)
+        paths.append(path)
+    return paths
+
+
+class QuietReporter(Reporter):
+    """Reporter that drops all output, so it doesn't skew the timings"""
+
+    def status_message(self, message):
+        pass
+
+    def output(self, host, prefix, line):
+        pass
+
+
+def configure(root, remotes_root, destinations, settings=None):
+    """Configure root as project folder, with a destination per directory in remotes_root"""
+    rsync_settings = {
+        "ssh_binary": FAKE_SSH,
+        "ssh_multiplexing": False,
+        "sync_on_save_delay": 50,
+        "progress": False,
+        "options": [],
+        "excludes": [],
+        "remotes": {
+            os.path.basename(root): [
+                {
+                    "remote_host": "bench-" + str(number),
+                    "remote_path": os.path.join(remotes_root, str(number)),
+                    "remote_user": "",
+                    "remote_port": "",
+                    "enabled": 1,
+                }
+                for number in range(destinations)
+            ]
+        },
+    }
+    rsync_settings.update(settings or {})
+    return Config(rsync_settings, [root], os.path.join(os.path.dirname(root), "bench.sublime-project"))
+
+
+def create_engine(workdir):
+    """Create engine with its cache in workdir"""
+    return SyncEngine(os.path.join(workdir, "cache"), QuietReporter())
+
+
+def report(scenario, parameters, results):
+    """Print a line of results"""
+    print(
+        scenario.ljust(11)
+        + " ".join(key + "=" + str(value) for key, value in parameters)
+        + " | "
+        + " ".join(key + "=" + value for key, value in results)
+    )
+    sys.stdout.flush()
+
+
+def bench_resolution(sizes, destination_counts, folder_count=6, lookups=10000):
+    """Resolve random saved paths to remotes"""
+    for size in sizes:
+        for destinations in destination_counts:
+            root = "/bench/project"
+            folders = [root + "/folder" + str(number) for number in range(folder_count)]
+            remotes = {}
+            for folder in folders:
+                destination_list = [{"remote_host": "h" + str(number)} for number in range(destinations)]
+                remotes[os.path.basename(folder)] = destination_list
+                remotes[os.path.basename(folder) + "/d0"] = destination_list
+            paths = [
+                random.choice(folders) + "/d" + str(number // 100) + "/f" + str(number) + ".txt"
+                for number in random.sample(range(size), min(size, lookups))
+            ]
+
+            started = time.perf_counter()
+            index = RemoteIndex(folders, remotes, root + "/bench.sublime-project")
+            build_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            matches = 0
+            for path in paths:
+                matches += sum(len(remote.destinations) for remote in index.lookup(path))
+            lookup_time = time.perf_counter() - started
+
+            report(
+                "resolution",
+                [("files", size), ("folders", folder_count), ("destinations", destinations)],
+                [
+                    ("build", "%.3fms" % (build_time * 1000)),
+                    ("lookup", "%.2fus" % (lookup_time / len(paths) * 1000000)),
+                    ("matches", str(matches)),
+                ],
+            )
+
+
+class NoopRsync(Rsync):
+    """Rsync job that doesn't run rsync, for measuring the queue and scheduler on their own"""
+
+    runs = 0
+    lock = threading.Lock()
+
+    def run(self):
+        with NoopRsync.lock:
+            NoopRsync.runs += 1
+
+
+def bench_dispatch(destination_counts, bursts):
+    """Queue and dispatch bursts of saves"""
+    workdir = tempfile.mkdtemp(prefix="rsync-ssh-bench-")
+    try:
+        root = os.path.join(workdir, "project")
+        paths = make_tree(root, max(bursts), file_size=1)
+        engine = create_engine(workdir)
+        rsync_ssh_core.engine.Rsync = NoopRsync
+        try:
+            for destinations in destination_counts:
+                config = configure(root, os.path.join(workdir, "remotes"), destinations)
+                for burst in bursts:
+                    NoopRsync.runs = 0
+                    started = time.perf_counter()
+                    for path in paths[:burst]:
+                        engine.sync(config, path, delay=config.get("sync_on_save_delay") / 1000.0)
+                    queued = time.perf_counter() - started
+                    engine.wait()
+                    total = time.perf_counter() - started
+                    report(
+                        "dispatch",
+                        [("destinations", destinations), ("burst", burst)],
+                        [
+                            ("queue", "%.2fms" % (queued * 1000)),
+                            ("total", "%.1fms" % (total * 1000)),
+                            ("jobs", str(NoopRsync.runs)),
+                        ],
+                    )
+        finally:
+            rsync_ssh_core.engine.Rsync = Rsync
+            engine.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_save(sizes, destination_counts, bursts):
+    """Save to synced latency for bursts of saves into an already synced tree"""
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix="rsync-ssh-bench-")
+        try:
+            root = os.path.join(workdir, "project")
+            paths = make_tree(root, size)
+            engine = create_engine(workdir)
+            for destinations in destination_counts:
+                remotes_root = tempfile.mkdtemp(dir=workdir)
+                config = configure(root, remotes_root, destinations)
+
+                # Initial sync, so we only measure the saves
+                engine.sync(config)
+                engine.wait()
+
+                for burst in bursts:
+                    saved = random.sample(paths, min(burst, len(paths)))
+                    for path in saved:
+                        with open(path, "ab") as file:
+                            file.write(b".")
+
+                    os.environ["FAKE_SSH_LOG"] = os.path.join(workdir, "ssh.log")
+                    with SpawnCounter() as spawned:
+                        started = time.perf_counter()
+                        for path in saved:
+                            engine.sync(config, path, delay=config.get("sync_on_save_delay") / 1000.0)
+                        engine.wait()
+                        latency = time.perf_counter() - started
+                    with open(os.environ.pop("FAKE_SSH_LOG")) as log_file:
+                        ssh_count = len(log_file.readlines())
+                    os.unlink(os.path.join(workdir, "ssh.log"))
+
+                    report(
+                        "save",
+                        [("files", size), ("destinations", destinations), ("burst", burst)],
+                        [
+                            ("latency", "%.1fms" % (latency * 1000)),
+                            ("spawned", str(spawned.count)),
+                            ("ssh", str(ssh_count)),
+                        ],
+                    )
+            engine.close()
+        finally:
+            shutil.rmtree(workdir)
+
+
+def bench_agent(bursts, file_size=4096):
+    """Send bursts of saved files using the receiver agent, and check they arrived intact"""
+    workdir = tempfile.mkdtemp(prefix="rsync-ssh-bench-")
+    try:
+        remote_root = os.path.join(workdir, "remote")
+        agent = AgentClient([FAKE_SSH], "loopback", remote_root, sys.executable)
+
+        started = time.perf_counter()
+        agent.apply([({"op": "mkdir", "path": "."}, None)])
+        startup = time.perf_counter() - started
+
+        for burst in bursts:
+            files = [("d" + str(number % 10) + "/f" + str(number) + ".txt", os.urandom(file_size)) for number in range(burst)]
+            started = time.perf_counter()
+            answers = agent.apply([({"op": "write", "path": path, "mode": 0o644}, data) for path, data in files])
+            latency = time.perf_counter() - started
+
+            intact = all(answer.get("ok") for answer in answers)
+            for path, data in files:
+                with open(os.path.join(remote_root, path), "rb") as file:
+                    intact = intact and file.read() == data
+
+            report(
+                "agent",
+                [("burst", burst)],
+                [
+                    ("startup", "%.1fms" % (startup * 1000)),
+                    ("latency", "%.2fms" % (latency * 1000)),
+                    ("intact", str(intact)),
+                ],
+            )
+        agent.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_full(sizes, destination_counts):
+    """Full sync throughput into empty destinations"""
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix="rsync-ssh-bench-")
+        try:
+            root = os.path.join(workdir, "project")
+            make_tree(root, size)
+            engine = create_engine(workdir)
+            for destinations in destination_counts:
+                remotes_root = tempfile.mkdtemp(dir=workdir)
+                config = configure(root, remotes_root, destinations)
+
+                with SpawnCounter() as spawned:
+                    started = time.perf_counter()
+                    engine.sync(config)
+                    engine.wait()
+                    elapsed = time.perf_counter() - started
+
+                report(
+                    "full",
+                    [("files", size), ("destinations", destinations)],
+                    [
+                        ("elapsed", "%.2fs" % elapsed),
+                        ("files/s", "%.0f" % (size * destinations / elapsed)),
+                        ("MB/s", "%.1f" % (size * destinations * 1024 / elapsed / 1000000)),
+                        ("spawned", str(spawned.count)),
+                    ],
+                )
+            engine.close()
+        finally:
+            shutil.rmtree(workdir)
+
+
+def integers(value):
+    """Parse comma separated list of integers"""
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=integers, default=[1000, 10000], help="tree sizes in files")
+    parser.add_argument("--destinations", type=integers, default=[1, 4], help="number of destinations")
+    parser.add_argument("--bursts", type=integers, default=[1, 10, 40], help="number of files saved at once")
+    parser.add_argument(
+        "--scenarios",
+        default="resolution,dispatch,agent,save,full",
+        help="comma separated list of scenarios to run",
+    )
+    args = parser.parse_args()
+    scenarios = args.scenarios.split(",")
+
+    if "resolution" in scenarios:
+        bench_resolution(args.sizes, args.destinations)
+    if "dispatch" in scenarios:
+        bench_dispatch(args.destinations, args.bursts)
+    if "agent" in scenarios:
+        bench_agent(args.bursts)
+
+    if not shutil.which("rsync"):
+        print("rsync not found, skipping save and full scenarios")
+        return
+
+    if "save" in scenarios:
+        bench_save(args.sizes, args.destinations, args.bursts)
+    if "full" in scenarios:
+        bench_full(args.sizes, args.destinations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Stand-in for ssh that runs the remote command locally, for use as ssh_binary in benchmarks.
+
+Every invocation is logged to the file named by FAKE_SSH_LOG, so the benchmark can count connections.
+"""
+import os
+import sys
+
+# ssh options that take an argument
+OPTIONS_WITH_ARGUMENT = set("BbcDEeFIiJLlmOoPpQRSWw")
+
+
+def main(args):
+    """Skip options and host, and run the rest as a shell command"""
+    log = os.environ.get("FAKE_SSH_LOG")
+    if log:
+        with open(log, "a") as log_file:
+            log_file.write(" ".join(args) + "\n")
+
+    index = 0
+    while index < len(args) and args[index].startswith("-"):
+        option = args[index]
+        # Control commands, e.g. -O check and -O exit, always succeed
+        if option == "-O":
+            return 0
+        if option[-1] in OPTIONS_WITH_ARGUMENT and len(option) == 2:
+            index += 1
+        index += 1
+
+    # Skip host
+    command = " ".join(args[index + 1 :])
+    if not command:
+        return 0
+
+    os.execvp("sh", ["sh", "-c", command])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,60 +1,87 @@
-"""sublime-rsync-ssh: A Sublime Text 3 plugin for syncing local folders to remote servers."""
+"""sublime-rsync-ssh: A Sublime Text 3 plugin for syncing local folders to remote servers.
+
+This is the Sublime Text side of things, the actual syncing is done by the engine in rsync_ssh_core.
+"""
 import os
-import re
-import shlex
-import subprocess
 import threading
 
 import sublime
 import sublime_plugin
 
+from .rsync_ssh_core import Config, Reporter, SyncEngine
+from .rsync_ssh_core.config import settings_key
+from .rsync_ssh_core.drift import summary as drift_summary
+from .rsync_ssh_core.util import console_format, console_print, current_user
 
-def console_print(host, prefix, output):
-    """Print message to console"""
-    if host and prefix:
-        host = host + "[" + prefix + "]: "
-    elif host and not prefix:
-        host = host + ": "
-    elif not host and prefix:
-        host = os.path.basename(prefix) + ": "
-
-    output = "[rsync-ssh] " + host + output.replace("\n", "\n[rsync-ssh] " + host)
-    print(output)
 
-
-def console_show(window=sublime.active_window()):
+def console_show(window):
     """Show console panel"""
     window.run_command("show_panel", {"panel": "console", "toggle": False})
 
 
-def normalize_path(path):
-    """Normalizes path to Unix format, converting back- to forward-slashes."""
-    return path.strip().replace("\\", "/")
+class OutputPanel(object):
+    """Output panel for rsync output, appended in batches and trimmed to a maximum size"""
 
+    name = "rsync_ssh"
+
+    def __init__(self, window, max_size=1000000):
+        self.window = window
+        self.max_size = max_size
+        self.buffer = []
+        self.buffer_size = 0
+        self.lock = threading.Lock()
+
+    def write(self, line):
+        """Queue line for the panel, the panel is updated at most 10 times per second"""
+        with self.lock:
+            flush_scheduled = len(self.buffer) > 0
+            self.buffer.append(line + "\n")
+            self.buffer_size += len(line) + 1
+            # Drop the oldest lines, if the panel can't keep up
+            while self.buffer_size > self.max_size and len(self.buffer) > 1:
+                self.buffer_size -= len(self.buffer.pop(0))
+        if not flush_scheduled:
+            sublime.set_timeout(self.flush, 100)
+
+    def flush(self):
+        """Append queued lines to the panel"""
+        with self.lock:
+            characters = "".join(self.buffer)
+            self.buffer = []
+            self.buffer_size = 0
+
+        panel = self.window.find_output_panel(self.name)
+        if panel is None:
+            panel = self.window.create_output_panel(self.name)
+        panel.run_command("rsync_ssh_panel_append", {"characters": characters, "max_size": self.max_size})
 
-def current_user():
-    """Get current username from the environment"""
-    if "USER" in os.environ:
-        return os.environ["USER"]
-    elif "USERNAME" in os.environ:
-        return os.environ["USERNAME"]
-    else:
-        return "username"
 
+output_panels = {}
 
-def check_output(*args, **kwargs):
-    """Runs specified system command using subprocess.check_output()"""
-    startupinfo = None
-    if sublime.platform() == "windows":
-        # Don't let console window pop-up on Windows.
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        startupinfo.wShowWindow = subprocess.SW_HIDE
 
-    return subprocess.check_output(*args, universal_newlines=True, startupinfo=startupinfo, **kwargs)
+def output_panel(window):
+    """Get output panel for window, creating it if needed"""
+    panel = output_panels.get(window.id())
+    if panel is None:
+        panel = output_panels[window.id()] = OutputPanel(window)
+    return panel
 
 
-def rsync_ssh_settings(view=sublime.active_window().active_view()):
+class RsyncSshPanelAppendCommand(sublime_plugin.TextCommand):
+    """Append text to the output panel, removing lines from the top when it grows too large"""
+
+    def run(self, edit, characters="", max_size=1000000):
+        """Append characters and trim panel"""
+        self.view.set_read_only(False)
+        self.view.insert(edit, self.view.size(), characters)
+        if self.view.size() > max_size:
+            cut = self.view.line(self.view.size() - max_size).end() + 1
+            self.view.erase(edit, sublime.Region(0, cut))
+        self.view.set_read_only(True)
+        self.view.show(self.view.size())
+
+
+def rsync_ssh_settings(view):
     """Get settings from the sublime project file"""
     project_data = view.window().project_data()
 
@@ -62,10 +89,130 @@ def rsync_ssh_settings(view=sublime.active_window().active_view()):
     if project_data == None:
         return None
 
-    settings = view.window().project_data().get("settings", {}).get("rsync_ssh")
+    settings = project_data.get("settings", {}).get("rsync_ssh")
     return settings
 
 
+class SublimeReporter(Reporter):
+    """Shows progress from the sync engine in the status bar, the console and the output panel"""
+
+    def __init__(self, window):
+        self.window = window
+        self.view = None
+        self.use_output_panel = True
+
+    def status_view(self):
+        """View showing the status, the view that initiated the last sync"""
+        return self.view or self.window.active_view()
+
+    def console_show(self):
+        console_show(self.window)
+
+    def set_status(self, key, value):
+        view = self.status_view()
+        if view:
+            view.set_status(key, value)
+
+    def erase_status(self, key):
+        view = self.status_view()
+        if view:
+            view.erase_status(key)
+
+    def status_message(self, message):
+        sublime.status_message(message)
+
+    def output(self, host, prefix, line):
+        if self.use_output_panel:
+            output_panel(self.window).write(console_format(host, prefix, line))
+        else:
+            console_print(host, prefix, line)
+
+
+sync_engines = {}
+
+
+def sync_engine(window):
+    """Get sync engine for window, creating it if needed"""
+    engine = sync_engines.get(window.id())
+    if engine is None:
+        engine = sync_engines[window.id()] = SyncEngine(os.path.join(sublime.cache_path(), "rsync-ssh"), SublimeReporter(window))
+    return engine
+
+
+sync_configs = {}
+
+
+def rsync_ssh_config(view):
+    """Get configuration for the sync engine from the sublime project file, compiled once until the project changes"""
+    window = view.window()
+    project_file_name = window.project_file_name()
+    folders = window.folders()
+
+    # Projects without a file can be changed without us noticing, so they are compared by a hash of their settings
+    settings = None
+    fingerprint = None
+    if project_file_name:
+        try:
+            fingerprint = os.path.getmtime(project_file_name)
+        except OSError:
+            pass
+    else:
+        settings = rsync_ssh_settings(view)
+        fingerprint = settings_key(settings, folders, None)
+    key = (project_file_name, fingerprint, tuple(folders))
+    cached = sync_configs.get(window.id())
+    if cached and fingerprint is not None and cached[0] == key:
+        return cached[1]
+
+    if settings is None:
+        settings = rsync_ssh_settings(view)
+    config = Config(settings, folders, project_file_name) if settings else None
+    sync_configs[window.id()] = (key, config)
+    return config
+
+
+def close_sync_engine(window):
+    """Close all connections opened on behalf of window"""
+    sync_configs.pop(window.id(), None)
+    engine = sync_engines.pop(window.id(), None)
+    if engine:
+        engine.close()
+
+
+def plugin_unloaded():
+    """Close all connections when plugin is unloaded (e.g. when Sublime Text quits)"""
+    for engine in list(sync_engines.values()):
+        engine.close()
+    sync_engines.clear()
+
+
+class RsyncSshWatchListener(sublime_plugin.EventListener):
+    """Warm up the sync engine when a project is opened, and start or stop watching as the watch setting changes"""
+
+    def on_activated(self, view):
+        """Invoked when a view gets focus"""
+        window = view.window()
+        if window is None:
+            return
+        config = rsync_ssh_config(view)
+        if config and config.get("warm_up", True):
+            sync_engine(window).warm_up(config)
+        if config and (config.get("watch", False) or window.id() in sync_engines):
+            sync_engine(window).watch(config)
+
+
+class RsyncSshConnectionListener(sublime_plugin.EventListener):
+    """Tear down ssh connections when the project is closed"""
+
+    def on_pre_close_project(self, window):
+        """Invoked when the project is closed"""
+        close_sync_engine(window)
+
+    def on_pre_close_window(self, window):
+        """Invoked when the window is closed"""
+        close_sync_engine(window)
+
+
 class RsyncSshInitSettingsCommand(sublime_plugin.TextCommand):
     """Sublime Command for creating the rsync_ssh block in the project settings file"""
 
@@ -143,6 +290,7 @@ class RsyncSshInitSettingsCommand(sublime_plugin.TextCommand):
 
             # Save configuration
             self.view.window().set_project_data(project_data)
+            sync_configs.pop(self.view.window().id(), None)
 
         # We won't clobber an existing configuration
         else:
@@ -157,19 +305,19 @@ class RsyncSshSyncSpecificRemoteCommand(sublime_plugin.TextCommand):
 
     remotes = []
     hosts = []
+    destinations = []
 
     def run(self, edit, **args):  # pylint: disable=W0613
         """Let user select which remote/destination to sync using the quick panel"""
 
-        settings = rsync_ssh_settings(self.view)
-        if not settings:
+        config = rsync_ssh_config(self.view)
+        if not config:
             console_print("", "", "Aborting! - rsync ssh is not configured!")
             return
 
         self.remotes = []
-        for remote_key in settings.get("remotes").keys():
-            for destination in settings.get("remotes").get(remote_key):
-                # print(remote)
+        for remote_key, destinations in config.remotes.items():
+            for destination in destinations:
                 if destination.get("enabled", True) == True:
                     if remote_key not in self.remotes:
                         self.remotes.append(remote_key)
@@ -188,7 +336,8 @@ class RsyncSshSyncSpecificRemoteCommand(sublime_plugin.TextCommand):
         if choice >= 0:
             self.view.settings().set("rsync_ssh_sync_specific_remote", choice)
 
-            destinations = rsync_ssh_settings(self.view).get("remotes").get(self.remotes[choice])
+            config = rsync_ssh_config(self.view)
+            destinations = config.remotes.get(self.remotes[choice], ()) if config else ()
 
             # Remote has no destinations, which makes no sense
             if len(destinations) == 0:
@@ -206,14 +355,9 @@ class RsyncSshSyncSpecificRemoteCommand(sublime_plugin.TextCommand):
                 )
             else:
                 self.hosts = [["All", "Sync to all destinations"]]
+                self.destinations = list(destinations)
                 for destination in destinations:
-                    d = []
-                    remote_user = destination.get("remote_user")
-                    if remote_user:
-                        d.append(remote_user + "@")
-                    d.append(destination.get("remote_host"))
-                    d.append(":" + str(destination.get("remote_port")))
-                    self.hosts.append(["".join(d), destination.get("remote_path")])
+                    self.hosts.append([destination.host_key, destination.get("remote_path")])
 
                 selected_destination = self.view.settings().get("rsync_ssh_sync_specific_destination", 0)
                 self.view.window().show_quick_panel(
@@ -233,7 +377,7 @@ class RsyncSshSyncSpecificRemoteCommand(sublime_plugin.TextCommand):
             self.view.settings().set("rsync_ssh_sync_specific_destination", choice)
 
             # Build restriction string
-            restrict_to_destinations = None if choice == 0 else self.hosts[choice][0] + ":" + self.hosts[choice][1]
+            restrict_to_destinations = None if choice == 0 else [self.destinations[choice - 1].key]
 
             # Start command thread to keep ui responsive
             self.view.run_command(
@@ -253,8 +397,8 @@ class RsyncSshSaveCommand(sublime_plugin.EventListener):
     def on_post_save(self, view):
         """Invoked each time the user saves a file."""
 
-        # Get settings
-        settings = rsync_ssh_settings(view)
+        # Get compiled settings, which are cached until the project changes
+        settings = rsync_ssh_config(view)
 
         # Don't do anything if rsync-ssh hasn't been configured
         if not settings:
@@ -267,16 +411,13 @@ class RsyncSshSaveCommand(sublime_plugin.EventListener):
         if os.path.basename(view.file_name()) == "COMMIT_EDITMSG":
             return
 
-        # Return if we are already syncing the file
-        if view.get_status("00000_rsync_ssh_status"):
-            if settings.get("debug", False) == True:
-                print("Sync already in progress")
+        # The watcher picks up saves along with all other changes
+        engine = sync_engines.get(view.window().id())
+        if engine and engine.watching() and not settings.get("sync_all_on_save", False):
             return
 
-        # Block other instances of the same file from initiating sync (e.g. files open in more than one view)
-        view.set_status("00000_rsync_ssh_status", "Sync initiated")
-
-        options = {}
+        # Saves are queued and coalesced per destination, so a sync already in progress will pick up this file when done
+        options = {"debounce": True}
         if not settings.get("sync_all_on_save", False):
             options["path_being_saved"] = view.file_name()
 
@@ -291,524 +432,128 @@ class RsyncSshSyncCommand(sublime_plugin.TextCommand):
         """Start thread with rsync to keep ui responsive"""
 
         # Get settings
-        settings = rsync_ssh_settings(self.view)
-        if not settings:
+        config = rsync_ssh_config(self.view)
+        if not config:
             console_print("", "", "Aborting! - rsync ssh is not configured!")
             return
 
+        engine = sync_engine(self.view.window())
+        engine.reporter.view = self.view
+        engine.reporter.use_output_panel = config.get("output_panel", True)
+
         # Start command thread to keep ui responsive
-        thread = RsyncSSH(
-            self.view,
-            settings,
-            args.get("path_being_saved", ""),
-            args.get("restrict_to_destinations", None),
-            args.get("force_sync", False),
+        thread = threading.Thread(
+            target=engine.sync,
+            args=(
+                config,
+                args.get("path_being_saved", ""),
+                args.get("restrict_to_destinations", None),
+                args.get("force_sync", False),
+                config.get("sync_on_save_delay", 250) / 1000.0 if args.get("debounce", False) else 0,
+            ),
         )
         thread.start()
 
 
-def build_ssh_destination_string(destination):
-    """Build SSH destination string: (user@)host(:port)"""
-
-    user = destination.get("remote_user")
-    host = destination.get("remote_host")
-    port = destination.get("remote_port")
-
-    parts = [
-        user + "@" if user else None,
-        host,
-        ":" + str(port) if port else None,
-    ]
-    return "".join(filter(None, parts))
-
-
-def build_rsync_destination_string(destination, path=None):
-    if path is None:
-        path = destination.get("remote_path")
-    return build_ssh_destination_string(destination) + ":" + shlex.quote(path)
-
-
-class RsyncSSH(threading.Thread):
-    """Rsync path to remote"""
-
-    def __init__(
-        self,
-        view,
-        settings,
-        path_being_saved="",
-        restrict_to_destinations=None,
-        force_sync=False,
-    ):
-        """Set the stage"""
-        self.view = view
-        self.settings = settings
-        self.path_being_saved = normalize_path(path_being_saved)
-        self.restrict_to_destinations = restrict_to_destinations
-        self.force_sync = force_sync
-        threading.Thread.__init__(self)
-
-    def run(self):
-        """Iterate over remotes and destinations and sync all paths that match the saved path"""
-
-        # Merge settings with defaults
-        global_excludes = [".DS_Store"]
-        global_excludes.extend(self.settings.get("excludes", []))
-
-        global_options = []
-        global_options.extend(self.settings.get("options", []))
-
-        connect_timeout = self.settings.get("timeout", 10)
-
-        # Get path to local ssh binary
-        ssh_binary = self.settings.get("ssh_binary", self.settings.get("ssh_command", "ssh"))
-
-        # Each rsync is started in a separate thread
-        threads = []
-
-        # Iterate over project folders, as we need to know where they are in the file system (they are the containers)
-        for folder_path_full in self.view.window().folders():
-            folder_path_basename = os.path.basename(folder_path_full)
-
-            # Iterate over remotes which is indexed by the local folder path
-            for remote_key in self.settings.get("remotes").keys():
-                # Disallow use of . as remote_key when more than one remote is present
-                if remote_key == "." and len(self.settings.get("remotes").keys()) > 1:
-                    console_print(
-                        "",
-                        folder_path_basename,
-                        "Use of . is ambiguous when project has more than one folder.",
-                    )
-                    continue
-
-                # Resolve local path to absolute path
-                local_path = ""
-
-                # Setup logging prefix - default to base name of the container folder
-                prefix = folder_path_basename
-
-                # We have a remote with a regular path, lets update the prefix with subfolder name if it exists
-                if remote_key != ".":
-                    # Just continue if remote_key doesn't contain the folder_path_basename, it means
-                    # the remote_key(local_path) is not within the directory we are processing now
-                    if not folder_path_basename in remote_key:
-                        continue
-
-                    # Look for subfolder in remote_key
-                    # If remote key is relative also get the split prefix so we can compose the container folder later
-                    [split_prefix, subfolder] = str.rsplit(remote_key, folder_path_basename, 1)
-                    # If split prefix is absolute, we'll remove it to get a nice short prefix
-                    if split_prefix.startswith("/"):
-                        split_prefix = ""
-                    folder_path_basename = split_prefix + folder_path_basename
-
-                    # Get container folder from real folder, ignore the rest
-                    container_folder = (str.rsplit(folder_path_full, folder_path_basename, 1))[0]
-
-                    # Update prefix with subfolder and remove container folder to get nice short prefix
-                    prefix = split_prefix + prefix + subfolder
-                    prefix = prefix.replace(container_folder, "")
-
-                    # Remote key with absolute path and subfolder
-                    if remote_key.startswith(container_folder) and len(subfolder) > 0:
-                        local_path = container_folder + folder_path_basename + subfolder
-                    # Remote key with absolute path and no subfolder
-                    elif remote_key.startswith(container_folder) and len(subfolder) == 0:
-                        local_path = container_folder + folder_path_basename
-                    # Remote key with relative  path and subfolder
-                    elif remote_key.startswith(folder_path_basename) and len(subfolder) > 0:
-                        local_path = container_folder + folder_path_basename + subfolder
-                    # Remote key with relative  path and no subfolder
-                    elif remote_key.startswith(folder_path_basename) and len(subfolder) == 0:
-                        local_path = container_folder + folder_path_basename + subfolder
-                    # We tried everything, it should have worked ;-)
-                    else:
-                        console_print(
-                            "",
-                            "",
-                            "Unable to determine local path for " + remote_key,
-                        )
-                        continue
-                # We have a remote with '.' as path
-                else:
-                    # Remote key is current path, will only work with a single folder project
-                    local_path = os.path.dirname(self.view.window().project_file_name())
-
-                # Might have mixed slash characters on Windows.
-                local_path = normalize_path(local_path)
-
-                # For each remote destination iterate over each destination and start a rsync thread
-                for destination in self.settings.get("remotes").get(remote_key):
-                    # Don't sync if saving single file outside of current remotes local file path
-                    if (
-                        self.path_being_saved
-                        and os.path.isfile(self.path_being_saved)
-                        and not self.path_being_saved.startswith(local_path + "/")
-                    ):
-                        continue
-
-                    # Don't sync if directory path being saved does not match the local path
-                    if self.path_being_saved and os.path.isdir(self.path_being_saved) and self.path_being_saved != local_path:
-                        continue
-
-                    destination_string = build_rsync_destination_string(destination)
-
-                    # If this remote has restrictions, we'll respect them
-                    if self.restrict_to_destinations and destination_string not in self.restrict_to_destinations:
-                        continue
-
-                    # Merge local settings with global defaults
-                    local_excludes = list(global_excludes)
-                    local_excludes.extend(destination.get("excludes", []))
-
-                    local_options = list(global_options)
-                    local_options.extend(destination.get("options", []))
-
-                    thread = Rsync(
-                        self.view,
-                        ssh_binary,
-                        local_path,
-                        prefix,
-                        destination,
-                        local_excludes,
-                        local_options,
-                        connect_timeout,
-                        self.path_being_saved,
-                        self.force_sync,
-                    )
-                    threads.append(thread)
-
-                    # Update status message
-                    status_bar_message = "Rsyncing to " + str(len(threads)) + " destination"
-                    if len(self.view.window().folders()) > 1:
-                        status_bar_message += "s"
-                    self.view.set_status("00000_rsync_ssh_status", status_bar_message)
-
-                    thread.start()
-
-        # Wait for all threads to finish
-        if threads:
-            for thread in threads:
-                thread.join()
-            status_bar_message = self.view.get_status("00000_rsync_ssh_status")
-            self.view.set_status("00000_rsync_ssh_status", "")
-            sublime.status_message(status_bar_message + " - done.")
-            console_print("", "", "done")
-        else:
-            status_bar_message = self.view.get_status("00000_rsync_ssh_status")
-            self.view.set_status("00000_rsync_ssh_status", "")
-            sublime.status_message(status_bar_message + " - done.")
-
-        # Unblock sync
-        self.view.set_status("00000_rsync_ssh_status", "")
-        return
-        # # Don't sync if saving single file outside of project path
-        # if self.path_being_saved and not self.path_being_saved.startswith(folder_path_full+"/"):
-        #     continue
-
-
-class Rsync(threading.Thread):
-    """rsync executor"""
-
-    def __init__(
-        self,
-        view,
-        ssh_binary,
-        local_path,
-        prefix,
-        destination,
-        excludes,
-        options,
-        timeout,
-        specific_path,
-        force_sync=False,
-    ):
-        self.ssh_binary = ssh_binary
-        self.view = view
-        self.local_path = local_path
-        self.prefix = prefix
-        self.destination = destination
-        self.excludes = excludes
-        self.options = options
-        self.timeout = timeout
-        self.specific_path = specific_path
-        self.force_sync = force_sync
-        self.rsync_path = ""
-        threading.Thread.__init__(self)
-
-    def ssh_command_with_default_args(self):
-        """Get ssh command with defaults"""
-
-        # Build list with defaults
-        ssh_command = [
-            self.ssh_binary,
-            "-q",
-            "-T",
-            "-o",
-            "ConnectTimeout=" + str(self.timeout),
-        ]
-        if self.destination.get("remote_port"):
-            ssh_command.extend(["-p", str(self.destination.get("remote_port"))])
-
-        custom_ssh_args = rsync_ssh_settings(self.view).get("ssh_args", [])
-        ssh_command.extend(custom_ssh_args)
-
-        return ssh_command
-
-    def run(self):
-        # Cygwin version of rsync is assumed on Windows. Local path needs to be converted using cygpath.
-        if sublime.platform() == "windows":
-            try:
-                self.local_path = check_output(["cygpath", self.local_path]).strip()
-                if self.specific_path:
-                    self.specific_path = check_output(["cygpath", self.specific_path]).strip()
-            except subprocess.CalledProcessError as error:
-                console_show(self.view.window())
-                console_print(
-                    self.destination.get("remote_host"),
-                    self.prefix,
-                    "ERROR: Failed to run cygpath to convert local file path. Can't continue.",
-                )
-                console_print(
-                    self.destination.get("remote_host"),
-                    self.prefix,
-                    error.output,
-                )
-                return
+class RsyncSshCancelCommand(sublime_plugin.TextCommand):
+    """Cancel all queued and running syncs of the window"""
 
-        # Skip disabled destinations, unless we explicitly force a sync (e.g. for specific destinations)
-        if not self.force_sync and not self.destination.get("enabled", 1):
-            console_print(
-                self.destination.get("remote_host"),
-                self.prefix,
-                "Skipping, destination is disabled.",
-            )
+    def run(self, edit, **args):  # pylint: disable=W0613
+        """Kill running rsyncs and drop queued ones"""
+        engine = sync_engines.get(self.view.window().id())
+        if engine is None:
+            console_print("", "", "Nothing to cancel.")
             return
+        engine.cancel()
 
-        # What to rsync
-        source_path = self.local_path + "/"
-        destination_path = self.destination.get("remote_path")
-
-        # Handle specific path syncs (e.g. save events and specific remote)
-        if self.specific_path and os.path.isfile(self.specific_path) and self.specific_path.startswith(self.local_path + "/"):
-            source_path = self.specific_path
-            destination_path = self.destination.get("remote_path") + self.specific_path.replace(self.local_path, "")
-        elif self.specific_path and os.path.isdir(self.specific_path) and self.specific_path.startswith(self.local_path + "/"):
-            source_path = self.specific_path + "/"
-            destination_path = self.destination.get("remote_path") + self.specific_path.replace(self.local_path, "")
-
-        # Check ssh connection, and get path of rsync on the remote host
-        check_command = self.ssh_command_with_default_args()
-        check_command.extend(
-            [
-                build_ssh_destination_string(self.destination),
-                "LANG=C which rsync",
-            ]
-        )
 
-        settings = self.view.window().settings()
-        self.rsync_path = settings.get("rsync_ssh_path", "")
-        if not self.rsync_path:
-            try:
-                console_print("", "", "checking")
-                rsync_path = check_output(check_command, timeout=self.timeout, stderr=subprocess.STDOUT).rstrip()
-                if not rsync_path.endswith("/rsync"):
-                    console_show(self.view.window())
-                    message = "ERROR: Unable to locate rsync on " + self.destination.get("remote_host")
-                    console_print(self.destination.get("remote_host"), self.prefix, message)
-                    console_print(
-                        self.destination.get("remote_host"),
-                        self.prefix,
-                        rsync_path,
-                    )
-                    return
-                settings.set("rsync_ssh_path", rsync_path)
-                self.rsync_path = rsync_path
-            except subprocess.TimeoutExpired as error:
-                console_show(self.view.window())
-                console_print(
-                    self.destination.get("remote_host"),
-                    self.prefix,
-                    "ERROR: " + error.output,
-                )
-                return
-            except subprocess.CalledProcessError as error:
-                console_show(self.view.window())
-                if error.returncode == 255 and error.output == "":
-                    console_print(
-                        self.destination.get("remote_host"),
-                        self.prefix,
-                        "ERROR: ssh check command failed, have you accepted the remote host key?",
-                    )
-                    console_print(
-                        self.destination.get("remote_host"),
-                        self.prefix,
-                        "       Try running the ssh command manually in a terminal:",
-                    )
-                    console_print(
-                        self.destination.get("remote_host"),
-                        self.prefix,
-                        "       " + " ".join(error.cmd),
-                    )
-                else:
-                    console_print(
-                        self.destination.get("remote_host"),
-                        self.prefix,
-                        "ERROR: " + error.output,
-                    )
+class RsyncSshLatencyReportCommand(sublime_plugin.TextCommand):
+    """Show save to remote latency per destination, from the trace log"""
 
-                return
+    def run(self, edit, **args):  # pylint: disable=W0613
+        """Write summary to the output panel"""
+        panel = output_panel(self.view.window())
+        trace = sync_engine(self.view.window()).trace
+        lines = trace.summary()
+        if not lines:
+            lines = ["No syncs in trace log yet."]
+        panel.write(console_format("", "", "Latency report (" + trace.path + ")"))
+        for line in lines:
+            panel.write(console_format("", "", line))
+        self.view.window().run_command("show_panel", {"panel": "output." + OutputPanel.name})
 
-        # Remote pre command
-        if self.destination.get("remote_pre_command"):
-            pre_command = self.ssh_command_with_default_args()
-            pre_command.extend(
-                [
-                    build_ssh_destination_string(self.destination),
-                    '$SHELL -l -c "LANG=C cd '
-                    + self.destination.get("remote_path")
-                    + " && "
-                    + self.destination.get("remote_pre_command")
-                    + '"',
-                ]
-            )
-            try:
-                console_print(
-                    self.destination.get("remote_host"),
-                    self.prefix,
-                    "Running pre command: " + self.destination.get("remote_pre_command"),
-                )
-                output = check_output(pre_command, stderr=subprocess.STDOUT)
-                if output:
-                    output = re.sub(r"\n$", "", output)
-                    console_print(self.destination.get("remote_host"), self.prefix, output)
-            except subprocess.CalledProcessError as error:
-                console_show(self.view.window())
-                console_print(
-                    self.destination.get("remote_host"),
-                    self.prefix,
-                    "ERROR: " + error.output + "\n",
-                )
 
-        # Build rsync command
-        rsync_command = [
-            rsync_ssh_settings(self.view).get("command", "rsync"),
-            "-v",
-            "-zar",
-            "-e",
-            " ".join(self.ssh_command_with_default_args()),
-        ]
-
-        # We allow options to be specified as "--foo bar" in the config so we need to split all options on first space after the option name
-        for option in self.options:
-            if "=" not in option:
-                rsync_command.extend(option.split(" ", 1))
-            else:
-                rsync_command.append(option)
+class RsyncSshPreviewCommand(sublime_plugin.TextCommand):
+    """Dry run a sync of the project, showing what would be sent and deleted in the output panel"""
 
-        rsync_command.extend(
-            [
-                source_path,
-                build_rsync_destination_string(self.destination, destination_path),
-            ]
-        )
+    def run(self, edit, **args):  # pylint: disable=W0613
+        """Start thread with the dry run to keep ui responsive"""
+        config = rsync_ssh_config(self.view)
+        if not config:
+            console_print("", "", "Aborting! - rsync ssh is not configured!")
+            return
 
-        # Add excludes
-        for exclude in set(self.excludes):
-            rsync_command.append("--exclude=" + exclude)
-
-        rsync_path_prefix = rsync_ssh_settings(self.view).get("rsync_path_prefix", "").rstrip() + " "
-
-        # Add mkdir unless we have a --dry-run flag
-        if len([option for option in rsync_command if "--dry-run" in option]) == 0:
-            rsync_command.extend(
-                [
-                    "--rsync-path",
-                    rsync_path_prefix
-                    + "mkdir -p '"
-                    + os.path.dirname(destination_path)
-                    + "' && "
-                    + rsync_path_prefix
-                    + self.rsync_path,
-                ]
-            )
+        window = self.view.window()
+        engine = sync_engine(window)
+        engine.reporter.view = self.view
+        thread = threading.Thread(target=self.preview, args=(window, engine, config))
+        thread.start()
 
-        # Show actual rsync command in the console
-        console_print(
-            self.destination.get("remote_host"),
-            self.prefix,
-            " ".join(shlex.quote(a) for a in rsync_command),
-        )
+    @staticmethod
+    def preview(window, engine, config):
+        """Write changes per destination to the output panel"""
+        panel = output_panel(window)
+        panel.write(console_format("", "", "Sync preview, apply it to send exactly these changes"))
+        previews = engine.preview(config)
+        if not previews:
+            panel.write(console_format("", "", "Nothing to preview."))
+        for changes in previews:
+            for line in changes.summary():
+                panel.write(console_format(changes.destination.get("remote_host"), changes.prefix, line))
+        window.run_command("show_panel", {"panel": "output." + OutputPanel.name})
 
-        # Execute rsync
-        try:
-            output = check_output(rsync_command, stderr=subprocess.STDOUT)
-            # Fix rsync output to include relative remote path
-            if self.specific_path and os.path.isfile(self.specific_path):
-                destination_file_relative = re.sub(
-                    self.destination.get("remote_path") + "/?",
-                    "",
-                    destination_path,
-                )
-                destination_file_basename = os.path.basename(destination_file_relative)
-                output = re.sub(destination_file_basename, destination_file_relative, output)
-            console_print(self.destination.get("remote_host"), self.prefix, output)
-            if len([option for option in rsync_command if "--dry-run" in option]) != 0:
-                console_print(
-                    self.destination.get("remote_host"),
-                    self.prefix,
-                    "NOTICE: Nothing synced. Remove --dry-run from options to sync.",
-                )
-        except subprocess.CalledProcessError as error:
-            console_show(self.view.window())
-            if len([option for option in rsync_command if "--dry-run" in option]) != 0 and re.search(
-                "No such file or directory", error.output, re.MULTILINE
-            ):
-                console_print(
-                    self.destination.get("remote_host"),
-                    self.prefix,
-                    "WARNING: Unable to do dry run, remote directory " + os.path.dirname(destination_path) + " does not exist.",
-                )
-            else:
-                console_print(
-                    self.destination.get("remote_host"),
-                    self.prefix,
-                    "ERROR: " + error.output + "\n",
-                )
 
-        # Remote post command
-        if self.destination.get("remote_post_command"):
-            post_command = self.ssh_command_with_default_args()
-            post_command.extend(
-                [
-                    build_ssh_destination_string(self.destination),
-                    '$SHELL -l -c "LANG=C cd \\"'
-                    + self.destination.get("remote_path")
-                    + '\\" && '
-                    + self.destination.get("remote_post_command")
-                    + '"',
-                ]
-            )
-            try:
-                console_print(
-                    self.destination.get("remote_host"),
-                    self.prefix,
-                    "Running post command: " + self.destination.get("remote_post_command"),
-                )
-                output = check_output(
-                    post_command,
-                    stdin=subprocess.DEVNULL,
-                    stderr=subprocess.STDOUT,
-                )
-                if output:
-                    output = re.sub(r"\n$", "", output)
-                    console_print(self.destination.get("remote_host"), self.prefix, output)
-            except subprocess.CalledProcessError as error:
-                console_show(self.view.window())
-                console_print(
-                    self.destination.get("remote_host"),
-                    self.prefix,
-                    "ERROR: " + error.output + "\n",
-                )
+class RsyncSshApplyPreviewCommand(sublime_plugin.TextCommand):
+    """Send the changes shown by the last preview, if the files didn't change since"""
+
+    def run(self, edit, **args):  # pylint: disable=W0613
+        """Queue syncs of the previewed changes"""
+        config = rsync_ssh_config(self.view)
+        if not config:
+            console_print("", "", "Aborting! - rsync ssh is not configured!")
+            return
+
+        engine = sync_engine(self.view.window())
+        engine.reporter.view = self.view
+        engine.reporter.use_output_panel = config.get("output_panel", True)
+        if not engine.apply_preview(config):
+            engine.reporter.console_show()
+
+
+class RsyncSshCheckDriftCommand(sublime_plugin.TextCommand):
+    """Show files changed on the destinations since they were synced, e.g. by patching them on the server"""
+
+    def run(self, edit, **args):  # pylint: disable=W0613
+        """Start thread with the check to keep ui responsive"""
+        config = rsync_ssh_config(self.view)
+        if not config:
+            console_print("", "", "Aborting! - rsync ssh is not configured!")
+            return
+
+        window = self.view.window()
+        engine = sync_engine(window)
+        thread = threading.Thread(target=self.check_drift, args=(window, engine, config, args.get("force", False)))
+        thread.start()
 
-        # End of run
-        return
+    @staticmethod
+    def check_drift(window, engine, config, force):
+        """Write drifted files per destination to the output panel"""
+        panel = output_panel(window)
+        panel.write(console_format("", "", "Drift check, files changed on the destinations since they were synced"))
+        reports = engine.check_drift(config, force)
+        if not reports:
+            panel.write(console_format("", "", "No destinations checked."))
+        for report in reports:
+            for line in drift_summary(report):
+                panel.write(console_format("", "", line))
+        window.run_command("show_panel", {"panel": "output." + OutputPanel.name})
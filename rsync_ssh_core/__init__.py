@@ -0,0 +1,10 @@
+"""Sync engine for rsync-ssh, independent of Sublime Text.
+
+The Sublime Text plugin in rsync_ssh.py is a thin layer on top of this package, which can also be used from
+the command line: python -m rsync_ssh_core --help
+"""
+from .config import Config, load_project
+from .engine import SyncEngine
+from .reporter import Reporter
+
+__all__ = ["Config", "Reporter", "SyncEngine", "load_project"]
@@ -0,0 +1,6 @@
+"""Run the command line interface: python -m rsync_ssh_core"""
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,168 @@
+"""Agent transport: a persistent receiver on the remote host, for sending small changes without starting rsync."""
+import inspect
+import json
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+
+from . import remote_agent
+from .remote_agent import FRAME_HEADER, VERSION, read_exactly
+from .util import build_rsync_destination_string, startupinfo
+
+# Reads the agent source from stdin and runs it, the rest of stdin is the request stream
+AGENT_BOOTSTRAP = "import sys;exec(sys.stdin.buffer.read(int(sys.stdin.buffer.readline())))"
+
+# Number of requests sent before reading the answers, so the pipes never fill up in both directions
+PIPELINE_SIZE = 500
+
+
+class AgentError(Exception):
+    """The agent couldn't be started or failed to answer"""
+
+
+class AgentClient(object):
+    """Connection to a receiver agent on a single destination"""
+
+    def __init__(self, ssh_command, host_string, root, python="python3", command_prefix=""):
+        self.ssh_command = ssh_command
+        self.host_string = host_string
+        self.root = root
+        self.python = python
+        self.command_prefix = command_prefix
+        self.process = None
+        self.stderr = None
+        self.lock = threading.Lock()
+
+    def remote_command(self):
+        """Command starting the agent on the remote host"""
+        command = self.python + " -u -c " + shlex.quote(AGENT_BOOTSTRAP)
+        if self.command_prefix:
+            command = self.command_prefix.rstrip() + " " + command
+        return command
+
+    def start(self):
+        """Start agent and send it its source, must be called with the lock held"""
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen(
+                self.ssh_command + [self.host_string, self.remote_command()],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=self.stderr,
+                startupinfo=startupinfo(),
+            )
+        except OSError as error:
+            raise AgentError("Unable to start ssh: " + str(error))
+
+        source = inspect.getsource(remote_agent).encode("utf-8")
+        try:
+            self.process.stdin.write(str(len(source)).encode("ascii") + b"\n" + source)
+        except (IOError, OSError):
+            self.fail("Agent didn't start")
+        answers = self.send([({"op": "hello", "root": self.root}, None)])
+        if answers[0].get("version") != VERSION:
+            self.fail("Agent version mismatch")
+
+    def fail(self, message):
+        """Stop agent and raise error with what it wrote to stderr"""
+        self.stop()
+        output = b""
+        if self.stderr is not None:
+            self.stderr.seek(0)
+            output = self.stderr.read().strip()
+            self.stderr.close()
+            self.stderr = None
+        if output:
+            message += ": " + output.decode("utf-8", "replace")
+        raise AgentError(message)
+
+    def send(self, requests):
+        """Send list of (request, data) and get the answers, must be called with the lock held"""
+        answers = []
+        try:
+            for start in range(0, len(requests), PIPELINE_SIZE):
+                chunk = requests[start : start + PIPELINE_SIZE]
+                for request, data in chunk:
+                    payload = json.dumps(request).encode("utf-8")
+                    self.process.stdin.write(FRAME_HEADER.pack(len(payload)) + payload)
+                    if data is not None:
+                        self.process.stdin.write(FRAME_HEADER.pack(len(data)) + data)
+                self.process.stdin.flush()
+                for _ in chunk:
+                    (size,) = FRAME_HEADER.unpack(read_exactly(self.process.stdout, FRAME_HEADER.size))
+                    answers.append(json.loads(read_exactly(self.process.stdout, size).decode("utf-8")))
+        except (IOError, OSError, EOFError, ValueError):
+            self.fail("Lost connection to agent")
+        return answers
+
+    def apply(self, requests):
+        """Send requests, starting the agent if needed - returns the answers"""
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            return self.send(requests)
+
+    def stop(self):
+        """Stop agent"""
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+    def close(self):
+        """Stop agent, when the engine is closed"""
+        with self.lock:
+            self.stop()
+            if self.stderr is not None:
+                self.stderr.close()
+                self.stderr = None
+
+
+class AgentPool(object):
+    """Agents of an engine, one per destination"""
+
+    # Seconds we wait before trying to start an agent again, after it failed
+    retry_interval = 300
+
+    def __init__(self):
+        self.agents = {}
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    def get(self, destination, ssh_command, host_string, python="python3", command_prefix=""):
+        """Get agent for destination, or None if it failed recently"""
+        key = build_rsync_destination_string(destination)
+        with self.lock:
+            if time.time() - self.failed.get(key, 0) < self.retry_interval:
+                return None
+            if key not in self.agents:
+                self.agents[key] = AgentClient(ssh_command, host_string, destination.get("remote_path"), python, command_prefix)
+            return self.agents[key]
+
+    def fail(self, destination):
+        """Stop using agent for destination for a while"""
+        key = build_rsync_destination_string(destination)
+        with self.lock:
+            self.failed[key] = time.time()
+            agent = self.agents.pop(key, None)
+        if agent:
+            agent.close()
+
+    def close(self):
+        """Stop all agents"""
+        with self.lock:
+            agents = list(self.agents.values())
+            self.agents = {}
+        for agent in agents:
+            agent.close()
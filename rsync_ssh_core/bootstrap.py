@@ -0,0 +1,245 @@
+"""First sync to an empty destination, sending the whole tree as a tar stream instead of using rsync."""
+import gzip
+import os
+import shlex
+import subprocess
+import tarfile
+import tempfile
+
+from .manifest import DIRECTORY, scan
+from .util import check_output, console_print, startupinfo
+
+# Rsync options that don't change what a sync to an empty destination writes, or whose effect tar reproduces
+TAR_SHORT_OPTIONS = "aqvrtlpgoDEHSWPcIuhiz"
+TAR_LONG_OPTIONS = set(
+    [
+        "archive",
+        "quiet",
+        "verbose",
+        "recursive",
+        "times",
+        "links",
+        "perms",
+        "group",
+        "owner",
+        "devices",
+        "specials",
+        "executability",
+        "hard-links",
+        "sparse",
+        "whole-file",
+        "partial",
+        "partial-dir",
+        "progress",
+        "stats",
+        "checksum",
+        "ignore-times",
+        "size-only",
+        "update",
+        "human-readable",
+        "itemize-changes",
+        "info",
+        "debug",
+        "compress",
+        "compress-choice",
+        "compress-level",
+        "skip-compress",
+        "force",
+        "timeout",
+        "contimeout",
+        "modify-window",
+        "inplace",
+        "omit-dir-times",
+        "no-perms",
+        "no-owner",
+        "no-group",
+        "no-times",
+        "no-devices",
+        "no-specials",
+        "no-motd",
+        "no-inc-recursive",
+        "no-i-r",
+        "protect-args",
+        "secluded-args",
+    ]
+)
+
+
+class CountingWriter(object):
+    """Writes to a binary stream, counting the bytes written"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, data):
+        """Write data"""
+        self.stream.write(data)
+        self.count += len(data)
+        return len(data)
+
+    def flush(self):
+        """Flush stream"""
+        self.stream.flush()
+
+
+def remote_empty(job):
+    """Check if the remote path is missing or an empty folder, a folder that can't be listed is never empty"""
+    rsync_path_prefix = job.config.rsync_path_prefix.rstrip() + " "
+    path = shlex.quote(job.destination.get("remote_path"))
+    remote_command = (
+        rsync_path_prefix
+        + "test ! -e "
+        + path
+        + " || { "
+        + rsync_path_prefix
+        + "test -d "
+        + path
+        + " && "
+        + rsync_path_prefix
+        + "test -r "
+        + path
+        + " && listing=$("
+        + rsync_path_prefix
+        + "ls -A "
+        + path
+        + ') && test -z "$listing"; }'
+    )
+    command = job.ssh_command_with_default_args() + [job.destination.host_string, remote_command]
+    try:
+        check_output(command, stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT, timeout=job.config.timeout + 5)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+        return False
+    return True
+
+
+def tar_options(options):
+    """Get tar extract options matching the rsync options, or None if tar can't write the tree the way rsync would"""
+    # Rsync is always run with -a, which the options can only turn off
+    perms = True
+    owner = True
+    group = True
+    for option in options:
+        name = option.split("=", 1)[0].split(" ", 1)[0]
+        if name.startswith("--"):
+            name = name[2:]
+            if name not in TAR_LONG_OPTIONS and not name.startswith("delete"):
+                return None
+            if name in ("perms", "no-perms"):
+                perms = name == "perms"
+            if name in ("owner", "no-owner"):
+                owner = name == "owner"
+            if name in ("group", "no-group"):
+                group = name == "group"
+        elif name.startswith("-"):
+            if [flag for flag in name[1:] if flag not in TAR_SHORT_OPTIONS]:
+                return None
+    # Without -p the umask applies as it does for rsync, and ownership is only kept when rsync would try to keep it
+    return (" -p" if perms else "") + ("" if owner and group else " --no-same-owner")
+
+
+def tar_transfer(job, native_path):
+    """Send the whole tree to an empty destination as a tar stream, returns False if rsync should be used.
+
+    With many small files this is much faster than rsync, which exchanges messages for every file. Only the
+    entries found by the manifest scan are sent, so the excludes are honored. Later syncs use rsync as usual.
+    """
+    if not job.config.get("bootstrap_tar", True) or (job.manifest is not None and job.manifest.entries):
+        return False
+    extract_options = tar_options(job.options)
+    if extract_options is None:
+        console_print(
+            job.destination.get("remote_host"),
+            job.prefix,
+            "Not sending the tree as a tar stream, it can't apply all the rsync options.",
+        )
+        return False
+    if not remote_empty(job):
+        return False
+
+    entries = job.manifest_entries if job.manifest_entries is not None else scan(native_path, job.excludes)
+    compression, job.decisions["compression"] = job.engine.compression.choose(
+        job.config, job.destination, job.options, job.local_capabilities(), job.host
+    )
+    rsync_path_prefix = job.config.rsync_path_prefix.rstrip() + " "
+    remote_path = shlex.quote(job.destination.get("remote_path"))
+    remote_command = (
+        rsync_path_prefix
+        + "mkdir -p "
+        + remote_path
+        + " && "
+        + rsync_path_prefix
+        + "tar"
+        + extract_options
+        + " -C "
+        + remote_path
+        + (" -xzf -" if compression else " -xf -")
+    )
+    console_print(
+        job.destination.get("remote_host"),
+        job.prefix,
+        "Destination is empty, sending " + str(len(entries)) + " files and folders as a tar stream.",
+    )
+
+    output = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        job.ssh_command_with_default_args() + [job.destination.host_string, remote_command],
+        stdin=subprocess.PIPE,
+        stdout=output,
+        stderr=subprocess.STDOUT,
+        startupinfo=startupinfo(),
+    )
+    job.track(process)
+
+    # Fast compression, the link is rarely slower than gzip at its higher levels
+    writer = CountingWriter(process.stdin)
+    stream = gzip.GzipFile(fileobj=writer, mode="wb", compresslevel=1) if compression else writer
+    files = 0
+    size = 0
+    error_message = ""
+    try:
+        with tarfile.open(fileobj=stream, mode="w|") as archive:
+            for path in sorted(entries):
+                try:
+                    archive.add(os.path.join(native_path, path), path, recursive=False)
+                except (IOError, OSError) as error:
+                    # Removed while we were sending, or unreadable
+                    if process.poll() is not None:
+                        raise
+                    console_print(job.destination.get("remote_host"), job.prefix, "WARNING: " + str(error))
+                    continue
+                if entries[path] != DIRECTORY:
+                    files += 1
+                    size += entries[path][0]
+        if stream is not writer:
+            stream.close()
+    except (IOError, OSError, tarfile.TarError) as error:
+        error_message = str(error)
+    finally:
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+    returncode = process.wait()
+    with job.process_lock:
+        job.process = None
+    output.seek(0)
+    message = output.read().decode("utf-8", "replace").strip() or error_message
+    output.close()
+
+    if job.cancelled:
+        job.result = "cancelled"
+        console_print(job.destination.get("remote_host"), job.prefix, "Cancelled.")
+        return True
+    if returncode or error_message:
+        console_print(
+            job.destination.get("remote_host"),
+            job.prefix,
+            "Unable to send tar stream, using rsync instead: " + message,
+        )
+        return False
+
+    job.decisions["bootstrap"] = "tar"
+    job.stats = {"files_transferred": files, "total_size": size, "bytes_sent": writer.count}
+    job.engine.health.success(job.destination)
+    return True
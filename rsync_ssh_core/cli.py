@@ -0,0 +1,156 @@
+"""Command line interface for syncing a project outside the editor.
+
+    python -m rsync_ssh_core sync my.sublime-project
+    python -m rsync_ssh_core sync my.sublime-project --path my-project-folder/changed-file.py
+    python -m rsync_ssh_core preview my.sublime-project --apply
+    python -m rsync_ssh_core watch my.sublime-project
+    python -m rsync_ssh_core drift my.sublime-project
+    python -m rsync_ssh_core report
+"""
+import argparse
+import os
+import sys
+import time
+
+from .config import Config, load_project
+from .drift import summary as drift_summary
+from .engine import SyncEngine
+from .tracelog import sync_trace
+from .util import console_print
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rsync-ssh")
+
+
+def sync(args):
+    """Sync project, or just the given path"""
+    config = load_project(args.project)
+    if config is None:
+        console_print("", "", "Aborting! - rsync ssh is not configured!")
+        return 1
+
+    engine = SyncEngine(args.cache_dir)
+    try:
+        path = os.path.abspath(args.path) if args.path and os.path.exists(args.path) else args.path or ""
+        engine.sync(config, path, args.destination, args.force)
+        engine.wait()
+    finally:
+        engine.close()
+    return 0
+
+
+def preview(args):
+    """Show what a sync of the project would send and delete, and send exactly that if asked to"""
+    config = load_project(args.project)
+    if config is None:
+        console_print("", "", "Aborting! - rsync ssh is not configured!")
+        return 1
+
+    engine = SyncEngine(args.cache_dir)
+    try:
+        previews = engine.preview(config)
+        for changes in previews:
+            for line in changes.summary():
+                print(line)
+        if not args.apply or not any(changes.paths() for changes in previews):
+            return 0
+        if input("Apply these changes? [y/N] ").strip().lower() not in ("y", "yes"):
+            return 0
+        if not engine.apply_preview(config):
+            return 1
+        engine.wait()
+    finally:
+        engine.close()
+    return 0
+
+
+def watch(args):
+    """Sync changes as they happen, until interrupted"""
+    config = load_project(args.project)
+    if config is None:
+        console_print("", "", "Aborting! - rsync ssh is not configured!")
+        return 1
+
+    config = Config(dict(config.settings, watch=True), config.folders, config.project_file_name)
+    engine = SyncEngine(args.cache_dir)
+    try:
+        if config.get("warm_up", True):
+            engine.warm_up(config)
+        engine.watch(config)
+        if not engine.watching():
+            return 1
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        engine.close()
+
+
+def drift(args):
+    """Print files changed on the destinations since they were synced"""
+    config = load_project(args.project)
+    if config is None:
+        console_print("", "", "Aborting! - rsync ssh is not configured!")
+        return 1
+
+    engine = SyncEngine(args.cache_dir)
+    try:
+        reports = engine.check_drift(config, args.force)
+    finally:
+        engine.close()
+    for drift_report in reports:
+        for line in drift_summary(drift_report):
+            print(line)
+    drifted = [
+        drift_report for drift_report in reports if drift_report["changed"] or drift_report["missing"] or drift_report["extra"]
+    ]
+    return 3 if drifted else 0
+
+
+def report(args):
+    """Print latency report from the trace log"""
+    trace = sync_trace(os.path.join(args.cache_dir, "trace.jsonl"))
+    for line in trace.summary() or ["No syncs in trace log yet."]:
+        print(line)
+    return 0
+
+
+def main(argv=None):
+    """Parse arguments and run command"""
+    parser = argparse.ArgumentParser(prog="rsync_ssh_core", description="Sync project folders to remote servers")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="where to keep host cache and trace log")
+    commands = parser.add_subparsers(dest="command")
+
+    sync_parser = commands.add_parser("sync", help="sync project to its destinations")
+    sync_parser.add_argument("project", help="path to .sublime-project file")
+    sync_parser.add_argument("--path", help="only sync this file, folder or remote")
+    sync_parser.add_argument("--destination", help="only sync destinations matching (user@)host(:port):path")
+    sync_parser.add_argument("--force", action="store_true", help="also sync disabled destinations")
+    sync_parser.set_defaults(function=sync)
+
+    preview_parser = commands.add_parser("preview", help="show what a sync of the project would send and delete")
+    preview_parser.add_argument("project", help="path to .sublime-project file")
+    preview_parser.add_argument("--apply", action="store_true", help="send the previewed changes after confirming")
+    preview_parser.set_defaults(function=preview)
+
+    watch_parser = commands.add_parser("watch", help="sync changes to the project folders as they happen")
+    watch_parser.add_argument("project", help="path to .sublime-project file")
+    watch_parser.set_defaults(function=watch)
+
+    drift_parser = commands.add_parser("drift", help="show files changed on the destinations since they were synced")
+    drift_parser.add_argument("project", help="path to .sublime-project file")
+    drift_parser.add_argument("--force", action="store_true", help="check again, even if a recent result is cached")
+    drift_parser.set_defaults(function=drift)
+
+    report_parser = commands.add_parser("report", help="show sync latency per destination")
+    report_parser.set_defaults(function=report)
+
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 2
+    return args.function(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""Choice of rsync compression per destination, based on what both ends support and the measured throughput."""
+import collections
+import threading
+
+from .util import build_rsync_destination_string, percentile
+
+# Best first, as listed by rsync 3.2 and later in "Compress list" of rsync --version
+PREFERRED_ALGORITHMS = ["zstd", "lz4", "zlibx", "zlib"]
+
+# Suffixes of files that are already compressed, used along with the skip_compress setting
+DEFAULT_SKIP_COMPRESS = (
+    "7z apk avi bz2 deb gif gz iso jar jpeg jpg lz lz4 lzma lzo mkv mov mp3 mp4 ogg png rar rpm tbz tgz txz webm webp "
+    "woff woff2 xz zip zst"
+).split()
+
+# Options that mean the user has chosen compression by hand
+COMPRESSION_OPTIONS = ("-z", "--compress", "--no-compress", "--no-z", "--zc", "--compress-choice", "--old-compress")
+
+
+def version_tuple(version):
+    """Convert version string, e.g. 3.2.7, to a tuple of integers for comparison"""
+    parts = []
+    for part in version.split("."):
+        digits = "".join(character for character in part if character.isdigit())
+        parts.append(int(digits) if digits else 0)
+    return tuple(parts)
+
+
+class CompressionPolicy(object):
+    """Chooses how rsync compresses transfers to each destination.
+
+    With the default "auto" setting the best algorithm supported by both ends is used, unless the throughput
+    measured for the last large transfers to the destination shows that the link is fast enough without it.
+    """
+
+    # Number of recent transfers per destination the decision is based on
+    samples_kept = 5
+    # Transfers smaller than this are dominated by latency, and don't tell us anything about the link
+    min_sample_bytes = 1000000
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.samples = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Collect samples from the trace log, must be called with the lock held"""
+        if self.samples is not None:
+            return
+        self.samples = {}
+        for record in self.trace.records():
+            self.add(record)
+
+    def add(self, record):
+        """Add throughput sample from trace record, must be called with the lock held"""
+        seconds = record.get("stages", {}).get("transfer", 0)
+        sent = record.get("stats", {}).get("bytes_sent", 0)
+        if record.get("result") != "ok" or seconds <= 0 or sent < self.min_sample_bytes:
+            return
+        samples = self.samples.setdefault(record.get("destination"), collections.deque(maxlen=self.samples_kept))
+        samples.append(sent / seconds)
+
+    def observe(self, record):
+        """Learn from a completed sync"""
+        with self.lock:
+            if self.samples is not None:
+                self.add(record)
+
+    def throughput(self, destination):
+        """Median throughput in bytes per second of the last large transfers to destination, or None if unknown"""
+        with self.lock:
+            self.load()
+            samples = self.samples.get(build_rsync_destination_string(destination))
+            return percentile(list(samples), 50) if samples else None
+
+    def choose(self, config, destination, options, local_capabilities, remote_capabilities):
+        """Get rsync arguments for compressing transfers to destination, and the decision for the trace log"""
+        setting = destination.get("compress", config.get("compress", "auto"))
+
+        if [option for option in options if option.split("=", 1)[0] in COMPRESSION_OPTIONS]:
+            return [], {"mode": "options"}
+        if setting is False or setting == "off":
+            return [], {"mode": "off", "reason": "disabled"}
+
+        # Turn compression off when the link isn't the bottleneck
+        if setting == "auto" or setting is True:
+            throughput = self.throughput(destination) if setting == "auto" else None
+            threshold = config.get("compress_off_above", 50) * 1000000
+            if throughput is not None and throughput > threshold:
+                return [], {"mode": "off", "reason": "fast link, %.1fMB/s" % (throughput / 1000000)}
+            setting = None
+
+        arguments = ["--compress"]
+        decision = {"mode": "on"}
+
+        # Algorithms can be chosen with rsync 3.2 and later, on both ends
+        minimum = (3, 2)
+        if (
+            version_tuple(local_capabilities.get("version", "")) >= minimum
+            and version_tuple(remote_capabilities.get("version", "")) >= minimum
+        ):
+            supported = [
+                algorithm
+                for algorithm in PREFERRED_ALGORITHMS
+                if algorithm in local_capabilities.get("compress", []) and algorithm in remote_capabilities.get("compress", [])
+            ]
+            algorithm = setting if setting in supported else (supported[0] if supported else None)
+            if algorithm:
+                arguments.append("--compress-choice=" + algorithm)
+                decision["algorithm"] = algorithm
+
+        level = destination.get("compress_level", config.get("compress_level"))
+        if level is not None:
+            arguments.append("--compress-level=" + str(level))
+            decision["level"] = level
+
+        skip_compress = destination.get("skip_compress", config.get("skip_compress"))
+        if skip_compress:
+            arguments.append("--skip-compress=" + "/".join(sorted(set(DEFAULT_SKIP_COMPRESS + list(skip_compress)))))
+
+        return arguments, decision
@@ -0,0 +1,190 @@
+"""Configuration of a project, as given by the rsync_ssh block of the project settings."""
+import collections
+import hashlib
+import json
+import os
+import re
+import types
+
+from .util import (
+    build_rsync_destination_string,
+    build_ssh_destination_string,
+    build_ssh_host_string,
+    console_print,
+    normalize_path,
+)
+
+
+def freeze(value):
+    """Get read-only copy of a settings value, dicts become read-only mappings and lists become tuples"""
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return types.MappingProxyType(collections.OrderedDict((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """Get plain copy of a (frozen) settings value, with dicts and lists"""
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return collections.OrderedDict((key, thaw(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+
+class Frozen(object):
+    """Base class for objects whose attributes are set once, while they are built, and can't be changed after"""
+
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError(type(self).__name__ + " is immutable")
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError(type(self).__name__ + " is immutable")
+
+
+class Destination(Frozen):
+    """A destination, with the strings identifying it and the ssh command for it built once"""
+
+    __slots__ = ("settings", "key", "host_key", "host_string", "ssh_command")
+
+    def __init__(self, settings, ssh_command):
+        self.settings = freeze(settings)
+        self.key = build_rsync_destination_string(settings)
+        self.host_key = build_ssh_destination_string(settings)
+        self.host_string = build_ssh_host_string(settings)
+        self.ssh_command = tuple(ssh_command)
+
+    def get(self, key, default=None):
+        """Get setting of destination"""
+        return self.settings.get(key, default)
+
+
+class Config(Frozen):
+    """Settings of a project together with its folders, parsed and validated once.
+
+    The settings are copied into read-only mappings and tuples, so the config stays the same for as long as a sync
+    uses it even if the project changes.
+    """
+
+    __slots__ = (
+        "settings",
+        "folders",
+        "project_file_name",
+        "key",
+        "preview_key",
+        "remotes",
+        "ssh_binary",
+        "timeout",
+        "rsync_command",
+        "rsync_path_prefix",
+        "global_excludes",
+        "global_options",
+    )
+
+    def __init__(self, settings, folders, project_file_name=None):
+        settings = thaw(settings)
+        self.folders = tuple(normalize_path(folder) for folder in folders)
+        self.project_file_name = project_file_name
+        self.ssh_binary = settings.get("ssh_binary", settings.get("ssh_command", "ssh"))
+        self.timeout = settings.get("timeout", 10)
+        self.rsync_command = settings.get("command", "rsync")
+        self.rsync_path_prefix = settings.get("rsync_path_prefix", "")
+        self.global_excludes = tuple([".DS_Store"] + string_list(settings, "excludes"))
+        self.global_options = tuple(string_list(settings, "options"))
+
+        # ssh command without the multiplexing arguments, the same for every sync to a destination
+        ssh_command = [self.ssh_binary, "-q", "-T", "-o", "ConnectTimeout=" + str(self.timeout)]
+        remotes = collections.OrderedDict()
+        for remote_key, destinations in settings.get("remotes", {}).items():
+            if not isinstance(destinations, list):
+                console_print("", "", "Ignoring remote " + remote_key + ", its destinations must be a list.")
+                continue
+            remotes[remote_key] = []
+            for destination in destinations:
+                if not isinstance(destination, dict) or not destination.get("remote_host") or not destination.get("remote_path"):
+                    console_print("", "", "Ignoring destination of " + remote_key + " without remote_host or remote_path.")
+                    continue
+                destination_ssh_command = list(ssh_command)
+                if destination.get("remote_port"):
+                    destination_ssh_command.extend(["-p", str(destination.get("remote_port"))])
+                destination_ssh_command.extend(string_list(settings, "ssh_args"))
+                remotes[remote_key].append(Destination(destination, destination_ssh_command))
+            remotes[remote_key] = tuple(remotes[remote_key])
+
+        self.key = settings_key(settings, self.folders, project_file_name)
+        # Previews are dry runs whatever the options say, so adding or removing --dry-run doesn't outdate them
+        self.preview_key = settings_key(without_dry_run(settings), self.folders, project_file_name)
+        self.settings = freeze(settings)
+        self.remotes = types.MappingProxyType(remotes)
+
+    def get(self, key, default=None):
+        """Get setting"""
+        return self.settings.get(key, default)
+
+    @property
+    def excludes(self):
+        """Global excludes, merged with defaults - a new list every time, so it can be extended"""
+        return list(self.global_excludes)
+
+    @property
+    def options(self):
+        """Global rsync options - a new list every time, so it can be extended"""
+        return list(self.global_options)
+
+
+def settings_key(settings, folders, project_file_name):
+    """Get hash identifying settings and folders"""
+    key = json.dumps([settings, list(folders), project_file_name], sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def without_dry_run(settings):
+    """Get copy of settings without --dry-run in the global and destination options"""
+    settings = thaw(settings)
+    options_settings = [settings]
+    for destinations in settings.get("remotes", {}).values():
+        if isinstance(destinations, list):
+            options_settings.extend(destination for destination in destinations if isinstance(destination, dict))
+    for entry in options_settings:
+        if isinstance(entry.get("options"), list):
+            entry["options"] = [option for option in entry["options"] if not isinstance(option, str) or "--dry-run" not in option]
+    return settings
+
+
+def string_list(settings, key):
+    """Get setting that must be a list of strings, ignoring anything else"""
+    values = settings.get(key, [])
+    if not isinstance(values, list):
+        console_print("", "", "Ignoring " + key + ", it must be a list.")
+        return []
+    return [value for value in values if isinstance(value, str)]
+
+
+def strip_json_comments(text):
+    """Remove // and /* */ comments and trailing commas, as allowed in .sublime-project files"""
+    pattern = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.DOTALL)
+    text = pattern.sub(lambda match: match.group(1) or "", text)
+    return re.sub(r",(\s*[}\]])", r"\1", text)
+
+
+def load_project(project_file_name):
+    """Load configuration from a .sublime-project file, returns None if rsync_ssh isn't configured"""
+    with open(project_file_name, "r") as project_file:
+        project_data = json.loads(strip_json_comments(project_file.read()))
+
+    settings = project_data.get("settings", {}).get("rsync_ssh")
+    if not settings:
+        return None
+
+    # Folder paths are relative to the project file
+    project_dir = os.path.dirname(os.path.abspath(project_file_name))
+    folders = [
+        os.path.normpath(os.path.join(project_dir, os.path.expanduser(folder.get("path"))))
+        for folder in project_data.get("folders", [])
+    ]
+    return Config(settings, folders, os.path.abspath(project_file_name))
@@ -0,0 +1,175 @@
+"""Multiplexed ssh connections, so all the stages of a sync share a single ssh handshake."""
+import hashlib
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from .util import build_ssh_host_string, check_output, current_user, is_windows, popen
+
+
+def fail_fast(ssh_command):
+    """Get ssh command giving up after a second when the host doesn't respond, for a host we already waited for"""
+    command = []
+    for argument in ssh_command:
+        if argument.startswith("ConnectTimeout=") and command and command[-1] == "-o":
+            command.pop()
+        elif not argument.startswith("-oConnectTimeout="):
+            command.append(argument)
+    return command[:1] + ["-o", "ConnectTimeout=1"] + command[1:]
+
+
+class SshMaster(object):
+    """A single multiplexed ssh master connection"""
+
+    # How often we ask the master if it is still alive, when it is being reused
+    health_check_interval = 30
+
+    def __init__(self, ssh_command, host_string, control_path):
+        self.ssh_command = ssh_command
+        self.host_string = host_string
+        self.control_path = control_path
+        self.process = None
+        self.checked_at = 0
+        # Set when the host didn't respond within the timeout, so we don't wait for it again right away
+        self.failed_at = 0
+
+    def control_args(self):
+        """Arguments that makes ssh reuse the master connection"""
+        return ["-o", "ControlPath=" + self.control_path, "-o", "ControlMaster=no"]
+
+    def control_command(self, operation):
+        """Build ssh command for controlling the master: ssh -O <operation>"""
+        return self.ssh_command + ["-o", "ControlPath=" + self.control_path, "-O", operation, self.host_string]
+
+    def is_alive(self):
+        """Check that the master process is running and still accepts sessions"""
+        if self.process is None or self.process.poll() is not None:
+            return False
+        if time.time() - self.checked_at < self.health_check_interval:
+            return True
+        try:
+            check_output(self.control_command("check"), stderr=subprocess.STDOUT, timeout=5)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+            return False
+        self.checked_at = time.time()
+        return True
+
+    def open(self, timeout):
+        """Start master in the background and wait until it accepts sessions"""
+        if os.path.exists(self.control_path):
+            os.unlink(self.control_path)
+
+        master_command = self.ssh_command + [
+            "-o",
+            "ControlPath=" + self.control_path,
+            "-o",
+            "ControlMaster=yes",
+            "-o",
+            "ControlPersist=no",
+            "-N",
+            self.host_string,
+        ]
+        self.process = popen(master_command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # The control socket appears once the master has authenticated
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                return False
+            if os.path.exists(self.control_path):
+                self.checked_at = time.time()
+                return True
+            time.sleep(0.05)
+
+        # Still connecting, so there is no control socket to ask it to exit
+        self.process.kill()
+        self.process.wait()
+        self.process = None
+        self.failed_at = time.time()
+        return False
+
+    def close(self):
+        """Ask master to exit, and make sure it does"""
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                check_output(self.control_command("exit"), stderr=subprocess.STDOUT, timeout=5)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+                pass
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+
+class SshConnectionPool(object):
+    """Pool of multiplexed ssh connections, one master per (user, host, port)"""
+
+    # Seconds we connect directly after a master timed out, instead of waiting for a new master
+    retry_interval = 30
+
+    def __init__(self):
+        self.masters = {}
+        self.lock = threading.Lock()
+        # One lock per (user, host, port), so opening a master to a slow host doesn't hold up the others
+        self.key_locks = {}
+        self.control_dir = os.path.join(tempfile.gettempdir(), "rsync-ssh-" + current_user())
+
+    def ssh_command(self, ssh_command, destination, timeout):
+        """Extend ssh command with arguments for reusing the master connection, opening the master if needed"""
+
+        # Windows(cygwin) ssh can't multiplex, so we'll just connect every time
+        if is_windows():
+            return ssh_command
+
+        key = (destination.get("remote_user"), destination.get("remote_host"), destination.get("remote_port"))
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        # Others using the same host wait for the master being opened, so they can use it as well
+        with key_lock:
+            with self.lock:
+                master = self.masters.get(key)
+            # Settings changed since the master was opened, so start over
+            if master and master.ssh_command != ssh_command:
+                master.close()
+                master = None
+            if master and master.is_alive():
+                return ssh_command + master.control_args()
+            # The host didn't respond a moment ago, don't wait for a master again
+            if master and time.time() - master.failed_at < self.retry_interval:
+                return ssh_command
+
+            if not os.path.isdir(self.control_dir):
+                os.makedirs(self.control_dir, 0o700, exist_ok=True)
+
+            # Keep socket path short, unix sockets paths can't be longer than ~100 chars
+            digest = hashlib.sha1(repr((key, ssh_command)).encode("utf-8")).hexdigest()[:16]
+            master = SshMaster(ssh_command, build_ssh_host_string(destination), os.path.join(self.control_dir, digest))
+            with self.lock:
+                self.masters[key] = master
+            try:
+                opened = master.open(timeout)
+            except OSError:
+                opened = False
+
+        # We could not connect, so we let the caller connect on its own to get a proper error message. When the host
+        # didn't respond at all we already waited for the timeout, so the caller gives up as soon as it sees that too.
+        if not opened and master.failed_at:
+            return fail_fast(ssh_command)
+        if not opened:
+            return ssh_command
+
+        return ssh_command + master.control_args()
+
+    def close(self):
+        """Close all master connections"""
+        with self.lock:
+            for master in self.masters.values():
+                master.close()
+            self.masters = {}
@@ -0,0 +1,178 @@
+"""Drift detection: finds files changed on a destination since they were synced, from a single remote listing."""
+import json
+import os
+import threading
+import time
+
+from .manifest import DIRECTORY, file_hash
+from .util import console_print
+
+# Lists path, type, size and mtime of everything below the current folder, NUL separated (requires GNU find)
+INVENTORY_COMMAND = "find . -mindepth 1 -printf '%P\\t%y\\t%s\\t%T@\\0'"
+
+
+def parse_inventory(output):
+    """Parse output of INVENTORY_COMMAND into path -> (type, size, mtime)"""
+    inventory = {}
+    for record in output.split("\0"):
+        fields = record.rsplit("\t", 3)
+        if len(fields) != 4:
+            continue
+        path, kind, size, mtime = fields
+        try:
+            inventory[path] = (kind, int(size), float(mtime))
+        except ValueError:
+            continue
+    return inventory
+
+
+def compare(baseline, inventory, matcher, check_times=True):
+    """Compare remote inventory to the entries of what was synced, returns changed, suspicious, missing and extra paths.
+
+    Files of a different size or type have changed. Files of the same size with a different modification time are
+    suspicious, as they may just have been touched. Symbolic links are only checked for existence.
+    """
+    changed = []
+    suspicious = []
+    missing = []
+    for path, entry in baseline.items():
+        remote = inventory.get(path)
+        if remote is None:
+            missing.append(path)
+            continue
+        kind, size, mtime = remote
+        if kind == "l":
+            continue
+        if entry == DIRECTORY or kind == "d":
+            if (entry == DIRECTORY) != (kind == "d"):
+                changed.append(path)
+            continue
+        if kind != "f" or size != entry[0]:
+            changed.append(path)
+        elif check_times and int(mtime) != entry[1] // 1000000000:
+            suspicious.append(path)
+
+    # Only the topmost of extra folders, everything in them is extra as well
+    extra = []
+    for path in sorted(inventory):
+        if path in baseline or (extra and path.startswith(extra[-1] + "/")):
+            continue
+        if not matcher.excluded(path, inventory[path][0] == "d"):
+            extra.append(path)
+
+    return sorted(changed), sorted(suspicious), sorted(missing), extra
+
+
+def verify(local_path, baseline, paths, remote_hashes):
+    """Get paths whose remote content hash differs from the one synced, or can't be compared"""
+    changed = []
+    for path in paths:
+        entry = baseline[path]
+        expected = entry[2]
+        if expected is None:
+            # Without a hash in the manifest, the local file is only usable if it didn't change since it was synced
+            try:
+                stat = os.stat(os.path.join(local_path, path))
+                if [stat.st_size, stat.st_mtime_ns] == entry[:2]:
+                    expected = file_hash(os.path.join(local_path, path))
+            except (IOError, OSError):
+                pass
+        if expected is None or remote_hashes.get(path) != expected:
+            changed.append(path)
+    return changed
+
+
+def summary(report):
+    """Describe drift of a destination, a line per path"""
+    drifted = len(report["changed"]) + len(report["missing"]) + len(report["extra"])
+    line = report["destination"] + ": "
+    if drifted:
+        line += (
+            str(len(report["changed"]))
+            + " changed, "
+            + str(len(report["missing"]))
+            + " missing, "
+            + str(len(report["extra"]))
+            + " extra"
+        )
+    else:
+        line += "no drift"
+    line += " - " + str(report["files"]) + " remote files, checked " + str(int(time.time() - report["checked_at"])) + "s ago"
+    if report["hashed"]:
+        line += ", " + str(report["hashed"]) + " hashed"
+
+    lines = [line]
+    for mark, key in [("~", "changed"), ("-", "missing"), ("+", "extra")]:
+        for path in report[key]:
+            lines.append("    " + mark + " " + path)
+    return lines
+
+
+class DriftCache(object):
+    """Latest drift report per (local path, destination), persisted to disk"""
+
+    def __init__(self, path):
+        self.path = path
+        self.reports = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(local_path, destination_string):
+        """Cache key for local path and destination"""
+        return local_path + "\t" + destination_string
+
+    def load(self):
+        """Load cache from disk, must be called with the lock held"""
+        if self.reports is not None:
+            return
+        try:
+            with open(self.path, "r") as cache_file:
+                self.reports = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            self.reports = {}
+
+    def save(self):
+        """Write cache to disk, must be called with the lock held"""
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path + ".tmp", "w") as cache_file:
+                json.dump(self.reports, cache_file, indent=4, sort_keys=True)
+            os.replace(self.path + ".tmp", self.path)
+        except (IOError, OSError) as error:
+            console_print("", "", "Unable to save drift cache: " + str(error))
+
+    def get(self, local_path, destination_string, ttl):
+        """Get cached report, unless it is older than ttl seconds"""
+        with self.lock:
+            self.load()
+            report = self.reports.get(self.key(local_path, destination_string))
+        if report and time.time() - report["checked_at"] < ttl:
+            return report
+        return None
+
+    def set(self, report):
+        """Cache report"""
+        with self.lock:
+            self.load()
+            self.reports[self.key(report["local_path"], report["destination"])] = report
+            self.save()
+
+    def forget(self, local_path, destination_string):
+        """Forget report, when a sync made it out of date"""
+        with self.lock:
+            self.load()
+            if self.reports.pop(self.key(local_path, destination_string), None) is not None:
+                self.save()
+
+
+drift_caches = {}
+drift_caches_lock = threading.Lock()
+
+
+def drift_cache(path):
+    """Get the drift cache stored at path, shared by everyone using the same file"""
+    with drift_caches_lock:
+        if path not in drift_caches:
+            drift_caches[path] = DriftCache(path)
+        return drift_caches[path]
@@ -0,0 +1,418 @@
+"""The sync engine: resolves changed paths to destinations and queues rsync jobs for them."""
+import collections
+import os
+import threading
+import time
+
+from .agent import AgentPool
+from .compression import CompressionPolicy
+from .connection import SshConnectionPool
+from .drift import drift_cache
+from .excludes import compile_excludes
+from .health import HostHealth
+from .hooks import HookRunner
+from .hostcache import host_cache
+from .index import RemoteIndex
+from .inventory import check_drift
+from .job import Rsync
+from .journal import change_journal
+from .manifest import ManifestStore, scan
+from .preview import ChangeSet
+from .reporter import Reporter
+from .scheduler import sync_scheduler
+from .syncqueue import SyncQueue
+from .tracelog import sync_trace
+from .util import console_print, normalize_path
+from .watcher import Inotify, Watcher
+
+
+class SyncEngine(object):
+    """Syncs local folders to their destinations, one engine per project"""
+
+    def __init__(self, cache_dir, reporter=None, scheduler=None):
+        self.cache_dir = cache_dir
+        self.reporter = reporter or Reporter()
+        self.scheduler = scheduler or sync_scheduler
+        self.connection_pool = SshConnectionPool()
+        self.agents = AgentPool()
+        self.queue = SyncQueue(self.reporter, self.scheduler)
+        self.host_cache = host_cache(os.path.join(cache_dir, "hosts.json"))
+        self.trace = sync_trace(os.path.join(cache_dir, "trace.jsonl"))
+        self.compression = CompressionPolicy(self.trace)
+        self.manifests = ManifestStore(os.path.join(cache_dir, "manifests"))
+        self.hooks = HookRunner()
+        self.health = HostHealth(self.reporter)
+        self.health.listeners.append(self.replay)
+        self.journal = change_journal(os.path.join(cache_dir, "journal.json"))
+        self.drift = drift_cache(os.path.join(cache_dir, "drift.json"))
+        # Latest config, for replaying the journal when a host is reachable again
+        self.config = None
+        self.replayed = False
+        self.warm_up_key = None
+        # Changes found by the last preview, until they are applied
+        self.previews = []
+        self.previews_key = None
+        self.index = None
+        self.index_key = None
+        self.watcher = None
+        self.watcher_key = None
+
+    def remote_index(self, config):
+        """Get remote index, it is only rebuilt when the folders or remotes change"""
+        if self.index is None or self.index_key != config.key:
+            self.index = RemoteIndex(config.folders, config.remotes, config.project_file_name)
+            self.index_key = config.key
+        return self.index
+
+    def resume(self, config):
+        """Remember config, and replay the changes journaled before the engine was started"""
+        self.config = config
+        if not self.replayed:
+            self.replayed = True
+            self.replay()
+
+    def replay(self, host=None):
+        """Queue the journaled changes as a single sync per destination, optionally only those for a single host"""
+        if self.config is None:
+            return
+        for entry in self.journal.pending(host):
+            # Changes for destinations that were removed or disabled since would never be sent
+            jobs = self.jobs(self.config, [entry["local_path"]], [entry["destination"]], False, True)
+            jobs = [job for job in jobs if job.local_path == entry["local_path"]]
+            if not jobs or not jobs[0].destination.get("enabled", 1):
+                console_print(
+                    entry["host"],
+                    "",
+                    "Dropping changes made while offline to "
+                    + entry["destination"]
+                    + " from the journal, the destination is "
+                    + ("disabled." if jobs else "no longer configured."),
+                )
+                self.journal.discard(entry["local_path"], entry["destination"], [])
+                continue
+
+            if not entry["full"]:
+                jobs = self.jobs(self.config, entry["paths"], [entry["destination"]])
+                jobs = [job for job in jobs if job.local_path == entry["local_path"]]
+
+            # Files deleted or excluded since are not synced, the same as when that happens before a save is synced
+            if not entry["full"]:
+                paths = set(path for job in jobs for path in job.specific_paths if os.path.exists(path))
+                dropped = [path for path in entry["paths"] if path not in paths]
+                if dropped:
+                    self.journal.discard(entry["local_path"], entry["destination"], dropped)
+                jobs = [job for job in jobs if not job.specific_paths or set(job.specific_paths) & paths]
+
+            for job in jobs:
+                console_print(job.destination.get("remote_host"), job.prefix, "Syncing changes made while offline.")
+                job.replay = True
+                self.queue.add(job)
+
+    def sync(self, config, path="", restrict_to_destinations=None, force_sync=False, delay=0):
+        """Iterate over remotes and destinations and queue a sync of all paths that match the given path"""
+        self.resume(config)
+        for job in self.jobs(config, [normalize_path(path)], restrict_to_destinations, force_sync, True):
+            # Each rsync is queued, so multiple saves to the same destination are sent using a single rsync
+            self.queue.add(job, delay)
+
+    def sync_paths(self, config, paths, delay=0):
+        """Queue a sync of a batch of changed paths, using a single rsync per destination"""
+        self.resume(config)
+        for job in self.jobs(config, [normalize_path(path) for path in paths if path]):
+            self.queue.add(job, delay)
+
+    def jobs(self, config, paths, restrict_to_destinations=None, force_sync=False, remote_folders_only=False):
+        """Resolve paths to their remotes and destinations, and get a rsync job for each destination.
+
+        With remote_folders_only a folder is only synced if it is the local path of a remote, as when syncing
+        a specific remote - otherwise it is synced to every remote containing it.
+        """
+
+        # Limit the number of concurrent rsyncs, both in total and per host
+        self.scheduler.configure(config.get("max_workers", 4), config.get("max_workers_per_host", 2))
+
+        # Paths to sync for each remote and destination, an empty list is a full sync
+        targets = collections.OrderedDict()
+        index = self.remote_index(config)
+        for path in paths:
+            # Resolve path to the remotes containing it
+            if not path:
+                remotes = index.remotes
+            elif os.path.isdir(path) and remote_folders_only:
+                remotes = index.lookup(path, exact=True)
+            elif os.path.isdir(path):
+                remotes = index.lookup(path, exact=True) + index.lookup(path)
+            elif not os.path.isfile(path) and path in index.remotes_by_key:
+                # Syncing specific remote by its key
+                remotes = index.remotes_by_key[path]
+            else:
+                remotes = index.lookup(path)
+
+            for remote in remotes:
+                # For each remote destination iterate over each destination and queue a rsync
+                for destination in remote.destinations:
+                    destination_string = destination.key
+
+                    # If this remote has restrictions, we'll respect them
+                    if restrict_to_destinations and destination_string not in restrict_to_destinations:
+                        continue
+
+                    # Excluded paths are skipped here, before any process is started
+                    matcher = compile_excludes(config.excludes + list(destination.get("excludes", [])))
+                    relative_path = path[len(remote.local_path) + 1 :]
+                    if path.startswith(remote.local_path + "/") and matcher.excluded(relative_path, os.path.isdir(path)):
+                        continue
+
+                    key = (remote.local_path, destination_string)
+                    if key not in targets:
+                        targets[key] = (remote, destination, [])
+                    specific_paths = targets[key][2]
+
+                    # Only pass on paths within the remote, the remote itself is a full sync
+                    if path.startswith(remote.local_path + "/"):
+                        if specific_paths is not None:
+                            specific_paths.append(path)
+                    else:
+                        targets[key] = (remote, destination, None)
+
+        jobs = []
+        for remote, destination, specific_paths in targets.values():
+            # Merge local settings with global defaults
+            local_excludes = config.excludes
+            local_excludes.extend(destination.get("excludes", []))
+
+            local_options = config.options
+            local_options.extend(destination.get("options", []))
+
+            jobs.append(
+                Rsync(
+                    self,
+                    config,
+                    remote.local_path,
+                    remote.prefix,
+                    destination,
+                    local_excludes,
+                    local_options,
+                    specific_paths or [],
+                    force_sync,
+                )
+            )
+        return self.fan_out(config, jobs)
+
+    @staticmethod
+    def fan_out(config, jobs):
+        """Group jobs for identical destinations of the same remote, so the first one syncs and the others follow.
+
+        The leader writes a rsync batch, which is applied to the followers - see Rsync.fan_out()
+        """
+        leaders = collections.OrderedDict()
+        result = []
+        for job in jobs:
+            if not job.destination.get("fan_out", config.get("fan_out", False)):
+                result.append(job)
+                continue
+            key = (
+                job.local_path,
+                tuple(job.specific_paths),
+                tuple(job.excludes),
+                tuple(job.options),
+                bool(job.force_sync or job.destination.get("enabled", 1)),
+            )
+            if key in leaders:
+                leaders[key].followers.append(job)
+            else:
+                leaders[key] = job
+                result.append(job)
+        return result
+
+    def destinations(self, config):
+        """Get a job for a full sync to each destination, without grouping identical destinations"""
+        jobs = []
+        for job in self.jobs(config, [""]):
+            jobs.append(job)
+            jobs.extend(job.followers)
+            job.followers = []
+        return jobs
+
+    def preview(self, config):
+        """Dry run a full sync to every destination, and keep the changes found so they can be applied as they are.
+
+        Returns the changes per destination, destinations that couldn't be previewed are left out.
+        """
+        self.resume(config)
+        jobs = self.destinations(config)
+        for job in jobs:
+            job.options = [option for option in job.options if "--dry-run" not in option] + ["--dry-run", "--itemize-changes"]
+            job.changes = ChangeSet(job.local_path, job.prefix, job.destination)
+
+        self.scheduler.run_all([(job.destination.get("remote_host"), job.run, ()) for job in jobs])
+
+        self.previews = [job.changes for job in jobs if job.result == "ok"]
+        self.previews_key = config.preview_key
+        return self.previews
+
+    def apply_preview(self, config):
+        """Queue a sync of exactly the changes found by the last preview, returns False if they are out of date"""
+        previews = self.previews
+        if not previews:
+            console_print("", "", "Nothing to apply, preview the sync first.")
+            return False
+        if self.previews_key != config.preview_key:
+            console_print("", "", "Settings changed since the preview, preview the sync again.")
+            return False
+
+        # The previewed changes are only sent if they are still what a full sync would send
+        stale = set()
+        for changes in previews:
+            stale.update(os.path.join(changes.local_path, path) for path in changes.stale())
+        if stale:
+            console_print("", "", str(len(stale)) + " files changed since the preview, preview the sync again.")
+            return False
+
+        self.previews = []
+        changes_by_key = dict(((changes.local_path, changes.destination.key), changes) for changes in previews)
+        self.resume(config)
+        for job in self.destinations(config):
+            changes = changes_by_key.get((job.local_path, job.destination.key))
+            if changes is not None and changes.paths():
+                # The preview was the dry run, applying it sends the changes even if the options say --dry-run
+                job.options = [option for option in job.options if "--dry-run" not in option]
+                job.preview = changes
+                self.queue.add(job)
+        return True
+
+    def check_drift(self, config, force=False):
+        """Find files changed on the enabled destinations since they were synced, listing each of them in one command.
+
+        Reports are cached for drift_cache_ttl seconds, or until the next sync to the destination, unless forced.
+        Returns the report per destination, destinations that couldn't be checked are left out.
+        """
+        self.resume(config)
+        jobs = [job for job in self.destinations(config) if job.destination.get("enabled", 1)]
+        ttl = 0 if force else config.get("drift_cache_ttl", 300)
+        reports = [None] * len(jobs)
+
+        def check(number, job):
+            """Check destination, unless we have a recent report for it"""
+            report = self.drift.get(job.local_path, job.destination.key, ttl)
+            if report is None and not self.health.allow(job.destination):
+                console_print(job.destination.get("remote_host"), job.prefix, "Skipping drift check, host is down.")
+            elif report is None:
+                report = check_drift(job)
+                if report is not None:
+                    self.drift.set(report)
+            reports[number] = report
+
+        self.scheduler.run_all([(job.destination.get("remote_host"), check, (number, job)) for number, job in enumerate(jobs)])
+        return [report for report in reports if report is not None]
+
+    def warm_up(self, config):
+        """Prepare everything the first sync needs in the background, so it is as fast as the ones after it.
+
+        Only done again when the settings or folders change.
+        """
+        if self.warm_up_key == config.key:
+            return
+        self.warm_up_key = config.key
+        thread = threading.Thread(target=self.prepare, args=(config,), name="rsync-ssh-warm-up")
+        thread.daemon = True
+        thread.start()
+
+    def prepare(self, config):
+        """Build the remote index and compile the excludes, then connect to every host and get its rsync path"""
+        started = time.time()
+        self.resume(config)
+
+        # A job per destination, resolving the remotes and compiling the excludes on the way
+        jobs = [job for job in self.destinations(config) if job.destination.get("enabled", 1)]
+
+        # Connect to every host in parallel within the worker limits, a single destination per host is enough
+        hosts = collections.OrderedDict()
+        for job in jobs:
+            hosts.setdefault(job.destination.host_key, job)
+        self.scheduler.run_all([(job.destination.get("remote_host"), self.prepare_host, (job,)) for job in hosts.values()])
+        console_print("", "", "Ready to sync to " + str(len(hosts)) + " hosts, in " + "%.2fs" % (time.time() - started) + ".")
+
+        if config.get("warm_up_check", False):
+            self.check_divergence(config, jobs)
+
+    def prepare_host(self, job):
+        """Open ssh connection to the host of job, and get the path and capabilities of its rsync"""
+        if self.health.allow(job.destination):
+            job.ssh_command_with_default_args()
+            job.check_host()
+
+    def check_divergence(self, config, jobs):
+        """Report destinations that are missing local changes made since their last full sync, e.g. by git pull"""
+        use_hash = config.get("manifest_hash", False)
+        scans = {}
+        for job in jobs:
+            manifest = self.manifests.get(job.local_path, job.destination.key)
+            if not manifest.load():
+                continue
+            key = (job.local_path, tuple(job.excludes))
+            if key not in scans:
+                scans[key] = scan(job.local_path, job.excludes)
+            changed, deleted = manifest.diff(job.local_path, scans[key], use_hash)
+            if changed or deleted:
+                console_print(
+                    job.destination.get("remote_host"),
+                    job.prefix,
+                    str(len(changed))
+                    + " files changed and "
+                    + str(len(deleted))
+                    + " deleted since the last full sync, sync the project to send them.",
+                )
+
+    def watch(self, config):
+        """Start watching the local paths for changes, or stop if the watch setting is off.
+
+        The watcher is only restarted when the settings or folders changed since it was started.
+        """
+        if self.watcher_key == config.key:
+            return
+        self.unwatch()
+
+        if not config.get("watch", False):
+            return
+        # Failures are only reported once, they aren't retried until the settings or folders change
+        self.watcher_key = config.key
+        if not Inotify.available():
+            console_print("", "", "Unable to watch for changes, inotify is only available on Linux.")
+            return
+        try:
+            self.watcher = Watcher(self, config)
+        except OSError as error:
+            console_print("", "", "Unable to watch for changes: " + str(error))
+            return
+        self.watcher.start()
+
+    def watching(self):
+        """Check if changes are picked up by the watcher"""
+        return self.watcher is not None
+
+    def unwatch(self):
+        """Stop watching for changes"""
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        self.watcher_key = None
+
+    def wait(self, timeout=None):
+        """Wait until all queued syncs and the remote commands they requested are done"""
+        if not self.queue.wait(timeout):
+            return False
+        return self.hooks.wait(timeout)
+
+    def cancel(self):
+        """Cancel all queued and running syncs"""
+        count = self.queue.cancel_all()
+        console_print("", "", "Cancelled syncs to " + str(count) + " destination" + ("" if count == 1 else "s") + ".")
+
+    def close(self):
+        """Stop watching and close all connections"""
+        self.unwatch()
+        self.hooks.close()
+        self.health.close()
+        self.agents.close()
+        self.connection_pool.close()
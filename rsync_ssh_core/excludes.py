@@ -0,0 +1,137 @@
+"""Exclude patterns compiled to regular expressions, matching paths the way rsync does."""
+import hashlib
+import os
+import re
+import threading
+
+from .util import console_print
+
+
+def translate(pattern):
+    """Translate rsync wildcards to a regular expression: * and ? stop at slashes, ** doesn't"""
+    result = ""
+    index = 0
+    while index < len(pattern):
+        character = pattern[index]
+        if pattern.startswith("**", index):
+            result += ".*"
+            index += 2
+            continue
+        if character == "*":
+            result += "[^/]*"
+        elif character == "?":
+            result += "[^/]"
+        elif character == "\\" and index + 1 < len(pattern):
+            index += 1
+            result += re.escape(pattern[index])
+        elif character == "[":
+            # A ] right after the opening [ (or [! / [^) is part of the set
+            start = index + 1
+            if pattern[start : start + 1] in ("!", "^"):
+                start += 1
+            end = pattern.find("]", start + 1)
+            if end < 0:
+                result += re.escape(character)
+            else:
+                members = pattern[index + 1 : end]
+                if members.startswith("!"):
+                    members = "^" + members[1:]
+                result += "[" + members.replace("\\", "\\\\") + "]"
+                index = end
+        else:
+            result += re.escape(character)
+        index += 1
+    return result
+
+
+class ExcludeMatcher(object):
+    """Exclude patterns compiled into one regular expression per kind of pattern.
+
+    A pattern starting with / is anchored to the synced folder, one ending with / only matches folders.
+    Patterns containing a slash (or **) are matched against the end of the relative path, other patterns only
+    against the name. A pattern ending with /*** matches the folder and everything in it.
+    """
+
+    def __init__(self, excludes):
+        # Patterns in the order given, without duplicates, for the --exclude-from file
+        self.patterns = []
+        for pattern in excludes:
+            if pattern and pattern not in self.patterns:
+                self.patterns.append(pattern)
+
+        # (matches name or path, matches folders only) -> list of regular expressions
+        kinds = {(False, False): [], (False, True): [], (True, False): [], (True, True): []}
+        for pattern in self.patterns:
+            directory_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            anchored = pattern.startswith("/")
+            pattern = pattern.lstrip("/")
+
+            everything_in = pattern.endswith("/***")
+            if everything_in:
+                pattern = pattern[:-4]
+            full_path = anchored or "/" in pattern or "**" in pattern or everything_in
+
+            expression = translate(pattern)
+            if everything_in:
+                expression += "(?:/.*)?"
+            if full_path and not anchored:
+                expression = "(?:.*/)?" + expression
+            kinds[(full_path, directory_only)].append(expression)
+
+        self.expressions = {}
+        for kind, expressions in kinds.items():
+            if expressions:
+                self.expressions[kind] = re.compile("^(?:" + "|".join(expressions) + ")$", re.DOTALL)
+
+    def matches(self, relative_path, is_dir=False):
+        """Check if path matches one of the patterns, not looking at the folders it is in"""
+        name = relative_path.rsplit("/", 1)[-1]
+        for (full_path, directory_only), expression in self.expressions.items():
+            if directory_only and not is_dir:
+                continue
+            if expression.match(relative_path if full_path else name):
+                return True
+        return False
+
+    def excluded(self, relative_path, is_dir=False):
+        """Check if path is excluded, either by itself or because one of the folders it is in is excluded"""
+        if not self.expressions:
+            return False
+        components = relative_path.strip("/").split("/")
+        for depth in range(1, len(components)):
+            if self.matches("/".join(components[:depth]), True):
+                return True
+        return self.matches("/".join(components), is_dir)
+
+    def write(self, directory):
+        """Write patterns to a file for --exclude-from, named by its contents so it is only written once"""
+        contents = "".join("- " + pattern + "\n" for pattern in self.patterns)
+        path = os.path.join(directory, hashlib.sha1(contents.encode("utf-8")).hexdigest()[:16] + ".exclude")
+        with exclude_files_lock:
+            if os.path.exists(path):
+                return path
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with open(path + ".tmp", "w") as exclude_file:
+                    exclude_file.write(contents)
+                os.replace(path + ".tmp", path)
+            except (IOError, OSError) as error:
+                console_print("", "", "Unable to write exclude file: " + str(error))
+                return None
+        return path
+
+
+compiled_matchers = {}
+compiled_matchers_lock = threading.Lock()
+exclude_files_lock = threading.Lock()
+
+
+def compile_excludes(excludes):
+    """Get compiled matcher for the list of patterns, matchers are shared by everyone using the same patterns"""
+    key = tuple(excludes)
+    with compiled_matchers_lock:
+        if key not in compiled_matchers:
+            compiled_matchers[key] = ExcludeMatcher(excludes)
+        return compiled_matchers[key]
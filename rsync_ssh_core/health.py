@@ -0,0 +1,144 @@
+"""Health of remote hosts, so syncs to a host that is down fail fast instead of waiting for the connect timeout."""
+import threading
+import time
+
+from .util import build_ssh_destination_string, console_print
+
+# Status bar key for hosts that are down
+STATUS_KEY = "00002_rsync_ssh_health"
+
+
+class HostState(object):
+    """Health of a single (user, host, port)"""
+
+    def __init__(self):
+        self.failures = 0
+        # up, down or probing
+        self.state = "up"
+        self.backoff = 0
+        self.retry_at = 0
+        self.timer = None
+        self.probe = None
+
+
+class HostHealth(object):
+    """Circuit breaker per (user, host, port).
+
+    After a number of connection failures in a row the host is marked down, and syncs to it fail right away. The host
+    is probed in the background, waiting twice as long after every failed probe, and marked up again once it responds.
+    """
+
+    # Seconds until the first probe, and the longest we wait between probes
+    initial_backoff = 5
+    max_backoff = 300
+
+    def __init__(self, reporter):
+        self.reporter = reporter
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        # Called with the (user, host, port) of a host that is reachable again
+        self.listeners = []
+
+    @staticmethod
+    def key(destination):
+        """Health is tracked per (user, host, port)"""
+        return build_ssh_destination_string(destination)
+
+    def allow(self, destination):
+        """Check if we should try to sync to destination"""
+        with self.lock:
+            state = self.hosts.get(self.key(destination))
+            return state is None or state.state == "up"
+
+    def retry_in(self, destination):
+        """Seconds until the host of destination is probed again"""
+        with self.lock:
+            state = self.hosts.get(self.key(destination))
+            return max(0, int(state.retry_at - time.time())) if state else 0
+
+    def success(self, destination):
+        """Record that we reached the host of destination"""
+        self.up(self.key(destination))
+
+    def failure(self, destination, probe, threshold=3):
+        """Record failure to reach the host of destination, probe() is used to check when it is back"""
+        key = self.key(destination)
+        with self.lock:
+            state = self.hosts.get(key)
+            if state is None:
+                state = self.hosts[key] = HostState()
+            state.failures += 1
+            state.probe = probe
+            if state.state != "up" or state.failures < threshold:
+                return
+            state.state = "down"
+            state.backoff = self.initial_backoff
+            self.schedule(key, state)
+
+        console_print(destination.get("remote_host"), "", "Host is down, not syncing to it until it responds again.")
+        self.update_status()
+
+    def up(self, key):
+        """Mark host up, closing the circuit"""
+        with self.lock:
+            state = self.hosts.pop(key, None)
+            if state is None:
+                return
+            if state.timer:
+                state.timer.cancel()
+        if state.state != "up":
+            console_print(key, "", "Host is reachable again.")
+            self.update_status()
+            for listener in self.listeners:
+                listener(key)
+
+    def schedule(self, key, state):
+        """Probe host after the current backoff, must be called with the lock held"""
+        if self.closed:
+            return
+        state.retry_at = time.time() + state.backoff
+        state.timer = threading.Timer(state.backoff, self.run_probe, [key])
+        state.timer.daemon = True
+        state.timer.start()
+
+    def run_probe(self, key):
+        """Check if the host responds, and wait longer before the next probe if it doesn't"""
+        with self.lock:
+            state = self.hosts.get(key)
+            if self.closed or state is None or state.state == "up":
+                return
+            state.state = "probing"
+            state.timer = None
+            probe = state.probe
+        self.update_status()
+
+        if probe():
+            self.up(key)
+            return
+
+        with self.lock:
+            if self.hosts.get(key) is not state:
+                return
+            state.state = "down"
+            state.backoff = min(state.backoff * 2, self.max_backoff)
+            self.schedule(key, state)
+        self.update_status()
+
+    def update_status(self):
+        """Show the hosts that are down in the status bar"""
+        with self.lock:
+            hosts = sorted((key, state.state) for key, state in self.hosts.items() if state.state != "up")
+        if hosts:
+            self.reporter.set_status(STATUS_KEY, "Rsync: " + ", ".join(key + " " + state for key, state in hosts))
+        else:
+            self.reporter.erase_status(STATUS_KEY)
+
+    def close(self):
+        """Stop probing, when the engine is closed"""
+        with self.lock:
+            self.closed = True
+            for state in self.hosts.values():
+                if state.timer:
+                    state.timer.cancel()
+                    state.timer = None
@@ -0,0 +1,123 @@
+"""Remote pre and post commands, run single-flight per destination with bursts collapsed into one run."""
+import threading
+import time
+
+from .util import console_print
+
+
+class HookState(object):
+    """Runs of a single command on a single destination"""
+
+    def __init__(self):
+        self.function = None
+        self.delay = 0
+        # Requests are numbered, a run covers every request made before it started
+        self.requested = 0
+        self.completed = 0
+        self.result = None
+        self.running = False
+        self.timer = None
+
+
+class HookRunner(object):
+    """Runs remote commands so a new run never overlaps one in progress for the same destination.
+
+    Requests arriving while a command runs are collapsed into a single run after it, and with a delay a burst of
+    requests is collapsed into a single trailing run once no more requests have arrived for that long.
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.closed = False
+
+    def request(self, key, function, delay=0, wait=True):
+        """Ask for function(coalesced) to run for key, returns its result when waiting - the latest function is run"""
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                state = self.states[key] = HookState()
+            state.function = function
+            state.delay = delay
+            state.requested += 1
+            ticket = state.requested
+
+            if state.timer:
+                state.timer.cancel()
+                state.timer = None
+            if not state.running:
+                self.schedule(key, state)
+
+            if not wait:
+                return None
+            while state.completed < ticket and not self.closed:
+                self.done.wait()
+            return state.result
+
+    def schedule(self, key, state):
+        """Start run now, or after the delay - must be called with the lock held"""
+        if state.delay > 0:
+            state.timer = threading.Timer(state.delay, self.start, [key])
+            state.timer.daemon = True
+            state.timer.start()
+        else:
+            state.running = True
+            threading.Thread(target=self.run, args=(key,), name="rsync-ssh-hook").start()
+
+    def start(self, key):
+        """Start run, when the delay has passed without new requests"""
+        with self.lock:
+            state = self.states[key]
+            state.timer = None
+            if self.closed or state.running or state.requested == state.completed:
+                return
+            state.running = True
+        self.run(key)
+
+    def run(self, key):
+        """Run command, and run it once more if it was requested again meanwhile"""
+        with self.lock:
+            state = self.states[key]
+            target = state.requested
+            function = state.function
+            coalesced = target - state.completed
+
+        result = "error"
+        try:
+            result = function(coalesced)
+        except Exception as error:  # pylint: disable=W0703
+            console_print("", "", "ERROR: Remote command failed: " + str(error))
+        finally:
+            with self.lock:
+                state.completed = target
+                state.result = result
+                state.running = False
+                if state.requested > state.completed and not self.closed:
+                    self.schedule(key, state)
+                self.done.notify_all()
+
+    def idle(self):
+        """Check that no command is running or waiting to run, must be called with the lock held"""
+        return all(not state.running and state.requested == state.completed for state in self.states.values())
+
+    def wait(self, timeout=None):
+        """Wait until all requested commands have run, returns False on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while not self.idle() and not self.closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.done.wait(remaining)
+        return True
+
+    def close(self):
+        """Drop commands waiting for their delay to pass, when the engine is closed"""
+        with self.lock:
+            self.closed = True
+            for state in self.states.values():
+                if state.timer:
+                    state.timer.cancel()
+                    state.timer = None
+            self.done.notify_all()
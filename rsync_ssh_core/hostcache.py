@@ -0,0 +1,81 @@
+"""Cache of the rsync path and capabilities of each remote host."""
+import json
+import os
+import threading
+import time
+
+from .util import build_ssh_destination_string, console_print, parse_rsync_version
+
+
+class HostCache(object):
+    """Path and capabilities of rsync per (user, host, port), persisted to disk"""
+
+    def __init__(self, path):
+        self.path = path
+        self.hosts = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(destination):
+        """Cache key for destination"""
+        return build_ssh_destination_string(destination)
+
+    def load(self):
+        """Load cache from disk, must be called with the lock held"""
+        if self.hosts is not None:
+            return
+        try:
+            with open(self.path, "r") as cache_file:
+                self.hosts = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            self.hosts = {}
+
+    def save(self):
+        """Write cache to disk, must be called with the lock held"""
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path + ".tmp", "w") as cache_file:
+                json.dump(self.hosts, cache_file, indent=4, sort_keys=True)
+            os.replace(self.path + ".tmp", self.path)
+        except (IOError, OSError) as error:
+            console_print("", "", "Unable to save host cache: " + str(error))
+
+    def get(self, destination, ttl):
+        """Get cached host, unless it is older than ttl seconds"""
+        with self.lock:
+            self.load()
+            host = self.hosts.get(self.key(destination))
+        if host and time.time() - host.get("checked_at", 0) < ttl:
+            return host
+        return None
+
+    def set(self, destination, rsync_path, version_output):
+        """Cache rsync path and capabilities parsed from rsync --version"""
+        host = parse_rsync_version(version_output)
+        host["rsync_path"] = rsync_path
+        host["checked_at"] = time.time()
+        with self.lock:
+            self.load()
+            self.hosts[self.key(destination)] = host
+            self.save()
+        return host
+
+    def invalidate(self, destination):
+        """Forget host, e.g. when a transfer failed"""
+        with self.lock:
+            self.load()
+            if self.hosts.pop(self.key(destination), None) is not None:
+                self.save()
+
+
+host_caches = {}
+host_caches_lock = threading.Lock()
+
+
+def host_cache(path):
+    """Get the host cache stored at path, shared by everyone using the same file"""
+    with host_caches_lock:
+        if path not in host_caches:
+            host_caches[path] = HostCache(path)
+        return host_caches[path]
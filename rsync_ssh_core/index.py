@@ -0,0 +1,93 @@
+"""Index of remotes by local path."""
+import os
+import re
+
+from .util import console_print, normalize_path
+
+
+class IndexedRemote(object):
+    """A remote resolved to its absolute local path"""
+
+    def __init__(self, remote_key, local_path, prefix, destinations):
+        self.remote_key = remote_key
+        self.local_path = local_path
+        self.prefix = prefix
+        self.destinations = destinations
+
+
+class RemoteIndex(object):
+    """Remotes indexed by their local path, so a path is resolved to its remotes in O(path depth)"""
+
+    def __init__(self, folders, remotes, project_file_name):
+        self.remotes = []
+        self.remotes_by_key = {}
+        # Trie of path components, remotes are stored under the None key of the node for their local path
+        self.trie = {}
+
+        folders = [normalize_path(folder) for folder in folders]
+        for remote_key, destinations in remotes.items():
+            for local_path, prefix in self.resolve(remote_key, folders, project_file_name, len(remotes)):
+                remote = IndexedRemote(remote_key, local_path, prefix, destinations)
+                self.remotes.append(remote)
+                self.remotes_by_key.setdefault(remote_key, []).append(remote)
+                node = self.trie
+                for component in self.components(local_path):
+                    node = node.setdefault(component, {})
+                node.setdefault(None, []).append(remote)
+
+    @staticmethod
+    def components(path):
+        """Split path into its components"""
+        return [component for component in path.split("/") if component]
+
+    def resolve(self, remote_key, folders, project_file_name, remote_count):
+        """Resolve remote key to a list of (local path, logging prefix) for each matching project folder"""
+
+        # We have a remote with '.' as path
+        if remote_key == ".":
+            # Disallow use of . as remote_key when more than one remote is present
+            if remote_count > 1:
+                console_print("", "", "Use of . is ambiguous when project has more than one folder.")
+                return []
+            # Remote key is current path, will only work with a single folder project
+            if not project_file_name:
+                return []
+            local_path = normalize_path(os.path.dirname(project_file_name))
+            return [(local_path, os.path.basename(local_path))]
+
+        key_path = normalize_path(remote_key).rstrip("/")
+        key_components = self.components(key_path)
+        resolved = []
+        for folder in folders:
+            folder_components = self.components(folder)
+
+            # Remote key with absolute path, must be the folder or within it
+            if key_path.startswith("/") or re.match(r"^[A-Za-z]:/", key_path):
+                if key_path == folder or key_path.startswith(folder + "/"):
+                    resolved.append((key_path, os.path.basename(folder) + key_path[len(folder) :]))
+                continue
+
+            # Remote key with relative path, must start with the tail of the folder path, e.g. 'folder/subfolder'
+            for length in range(min(len(key_components), len(folder_components)), 0, -1):
+                if key_components[:length] == folder_components[-length:]:
+                    local_path = "/".join([folder] + key_components[length:])
+                    resolved.append((local_path, key_path))
+                    break
+
+        return resolved
+
+    def lookup(self, path, exact=False):
+        """Get remotes containing path, closest first - or only the remotes at path when exact"""
+        matches = []
+        node = self.trie
+        components = self.components(normalize_path(path))
+        for depth, component in enumerate(components):
+            # Remotes above the path contain it, unless we want an exact match
+            if not exact and None in node:
+                matches = node[None] + matches
+            node = node.get(component)
+            if node is None:
+                return [] if exact else matches
+            if exact and depth == len(components) - 1:
+                return list(node.get(None, []))
+        return matches
@@ -0,0 +1,98 @@
+"""Remote file inventory of a destination, compared to what was synced to it by the drift check."""
+import shlex
+import subprocess
+import time
+
+from .drift import INVENTORY_COMMAND, compare, parse_inventory, verify
+from .excludes import compile_excludes
+from .manifest import scan
+from .util import console_print, popen
+
+
+def run_remote(job, remote_command, data=None):
+    """Run command on the destination, passing data on stdin, returns its exit code, output and error output"""
+    command = job.ssh_command_with_default_args() + [job.destination.host_string, remote_command]
+    process = popen(
+        command,
+        stdin=subprocess.DEVNULL if data is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        output, errors = process.communicate(data, timeout=job.config.timeout + 60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+    return process.returncode, output, errors
+
+
+def list_files(job):
+    """List the files on the destination in a single remote command, returns None if that failed"""
+    rsync_path_prefix = job.config.rsync_path_prefix.rstrip() + " "
+    path = shlex.quote(job.destination.get("remote_path"))
+    try:
+        returncode, output, errors = run_remote(job, "cd " + path + " && " + rsync_path_prefix + INVENTORY_COMMAND)
+    except (subprocess.TimeoutExpired, OSError) as error:
+        console_print(job.destination.get("remote_host"), job.prefix, "ERROR: Unable to list remote files: " + str(error))
+        return None
+    if returncode != 0:
+        if returncode == 255:
+            job.connection_failed()
+        console_print(job.destination.get("remote_host"), job.prefix, "ERROR: Unable to list remote files: " + errors.strip())
+        return None
+    job.engine.health.success(job.destination)
+    return parse_inventory(output)
+
+
+def remote_hashes(job, paths):
+    """Get content hashes of paths on the destination, paths that can't be read are left out"""
+    rsync_path_prefix = job.config.rsync_path_prefix.rstrip() + " "
+    path = shlex.quote(job.destination.get("remote_path"))
+    try:
+        returncode, output, _ = run_remote(
+            job, "cd " + path + " && " + rsync_path_prefix + "xargs -0 sha1sum -- 2>/dev/null; true", "\0".join(paths)
+        )
+    except (subprocess.TimeoutExpired, OSError):
+        return {}
+    if returncode != 0:
+        return {}
+    hashes = {}
+    for line in output.splitlines():
+        digest, _, remote_path = line.partition("  ")
+        hashes[remote_path] = digest
+    return hashes
+
+
+def check_drift(job):
+    """Compare the files on the destination to what was last synced to it, returns the drift report or None.
+
+    What was synced is taken from the manifest, or from the local files when there is none yet. Only files of the
+    same size with another modification time are hashed, on both ends, when drift_hash is set.
+    """
+    started = time.time()
+    inventory = list_files(job)
+    if inventory is None:
+        return None
+
+    manifest = job.engine.manifests.get(job.local_path, job.destination.key)
+    baseline = dict(manifest.entries) if manifest.load() else scan(job.local_path, job.excludes)
+    check_times = not [option for option in job.options if option in ("--no-times", "--no-t")]
+    changed, suspicious, missing, extra = compare(baseline, inventory, compile_excludes(job.excludes), check_times)
+
+    hashed = 0
+    if suspicious and job.destination.get("drift_hash", job.config.get("drift_hash", False)):
+        hashed = len(suspicious)
+        suspicious = verify(job.local_path, baseline, suspicious, remote_hashes(job, suspicious))
+
+    return {
+        "local_path": job.local_path,
+        "destination": job.destination.key,
+        "checked_at": time.time(),
+        "seconds": round(time.time() - started, 3),
+        "files": len(inventory),
+        "hashed": hashed,
+        "changed": sorted(changed + suspicious),
+        "missing": missing,
+        "extra": extra,
+    }
@@ -0,0 +1,840 @@
+"""A single sync of a local folder to a destination."""
+import collections
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from .agent import AgentError
+from .bootstrap import tar_transfer
+from .excludes import compile_excludes
+from .manifest import Manifest, scan
+from .preview import plan_preview
+from .shards import sharded_transfer
+from .util import (
+    RSYNC_PROGRESS_PATTERN,
+    build_rsync_target_string,
+    check_output,
+    console_print,
+    is_windows,
+    local_rsync_capabilities,
+    parse_rsync_stats_line,
+    stream_output,
+)
+
+
+class Rsync(object):
+    """rsync executor, run by the scheduler"""
+
+    def __init__(
+        self,
+        engine,
+        config,
+        local_path,
+        prefix,
+        destination,
+        excludes,
+        options,
+        specific_paths,
+        force_sync=False,
+    ):
+        self.engine = engine
+        self.config = config
+        self.reporter = engine.reporter
+        self.local_path = local_path
+        # Local path as given, the local path is converted using cygpath on Windows
+        self.native_path = local_path
+        self.prefix = prefix
+        self.destination = destination
+        self.excludes = excludes
+        self.options = options
+        self.specific_paths = specific_paths
+        self.specific_path = ""
+        self.files_from = []
+        self.force_sync = force_sync
+        self.rsync_path = ""
+        self.host = {}
+        self.manifest = None
+        self.manifest_entries = None
+        self.deleted_paths = []
+        # Manifest entries of saved files, taken before they are sent - (entries, subdir) pairs
+        self.sent_entries = []
+        # Identical destinations the batch written by this sync is applied to, and the batch applied by a follower
+        self.followers = []
+        self.batch_path = None
+        self.batch_options = []
+        self.batch_dir = None
+        self.consistent = set()
+        # The running rsync, so the sync can be cancelled when a newer save of the same files arrives
+        self.process = None
+        self.cancelled = False
+        self.process_lock = threading.Lock()
+        # Set when the remote host couldn't be reached, the changes are kept in the journal
+        self.offline = False
+        # Set when syncing changes from the journal, which are dropped from it if they can't be sent for another reason
+        self.replay = False
+        # Shards of a sharded full sync, which use connections of their own
+        self.shards = []
+        self.multiplex = True
+        # Changes found by the dry run of a preview, and the previewed changes sent by applying it
+        self.changes = None
+        self.preview = None
+        # Timing and outcome of the sync, for the trace log
+        self.queued_at = time.time()
+        self.result = "ok"
+        self.stats = {}
+        self.timings = collections.OrderedDict()
+        self.current_stage = None
+        self.stage_started = 0
+        # Decisions made along the way, e.g. how a full sync was done
+        self.decisions = collections.OrderedDict()
+
+    def ssh_command_with_default_args(self, reuse_connection=True):
+        """Get ssh command with defaults"""
+
+        # Built once per destination when the config was compiled, with the port and custom arguments
+        ssh_command = list(self.destination.ssh_command)
+
+        # Reuse one ssh connection per destination for all the stages of the sync
+        if reuse_connection and self.multiplex and self.config.get("ssh_multiplexing", True):
+            ssh_command = self.engine.connection_pool.ssh_command(ssh_command, self.destination, self.config.timeout)
+
+        return ssh_command
+
+    def probe(self):
+        """Check if the remote host responds, used for finding out when a host that was down is back"""
+        command = self.ssh_command_with_default_args(False) + [self.destination.host_string, "true"]
+        try:
+            check_output(command, stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT, timeout=self.config.timeout + 5)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+            return False
+        return True
+
+    def connection_failed(self):
+        """Record that the remote host couldn't be reached, it is marked down after repeated failures"""
+        self.offline = True
+        self.engine.health.failure(self.destination, self.probe, self.config.get("host_down_after_failures", 3))
+
+    def check_host(self):
+        """Get path and capabilities of rsync on the remote host, checking the ssh connection if we don't know them"""
+        cache = self.engine.host_cache
+        host = cache.get(self.destination, self.config.get("host_cache_ttl", 86400))
+        if host:
+            self.host = host
+            self.rsync_path = host.get("rsync_path")
+        else:
+            check_command = self.ssh_command_with_default_args()
+            check_command.extend(
+                [
+                    self.destination.host_string,
+                    "LANG=C which rsync && LANG=C rsync --version",
+                ]
+            )
+            try:
+                console_print("", "", "checking")
+                output = check_output(check_command, timeout=self.config.timeout, stderr=subprocess.STDOUT)
+                rsync_path = output.split("\n", 1)[0].rstrip()
+                if not rsync_path.endswith("/rsync"):
+                    self.reporter.console_show()
+                    message = "ERROR: Unable to locate rsync on " + self.destination.get("remote_host")
+                    console_print(self.destination.get("remote_host"), self.prefix, message)
+                    console_print(
+                        self.destination.get("remote_host"),
+                        self.prefix,
+                        rsync_path,
+                    )
+                    return False
+                self.host = cache.set(self.destination, rsync_path, output)
+                self.engine.health.success(self.destination)
+                self.rsync_path = rsync_path
+            except subprocess.TimeoutExpired as error:
+                self.connection_failed()
+                self.reporter.console_show()
+                console_print(
+                    self.destination.get("remote_host"),
+                    self.prefix,
+                    "ERROR: " + (error.output or str(error)),
+                )
+                return False
+            except subprocess.CalledProcessError as error:
+                self.reporter.console_show()
+                if error.returncode == 255:
+                    self.connection_failed()
+                if error.returncode == 255 and error.output == "":
+                    console_print(
+                        self.destination.get("remote_host"),
+                        self.prefix,
+                        "ERROR: ssh check command failed, have you accepted the remote host key?",
+                    )
+                    console_print(
+                        self.destination.get("remote_host"),
+                        self.prefix,
+                        "       Try running the ssh command manually in a terminal:",
+                    )
+                    console_print(
+                        self.destination.get("remote_host"),
+                        self.prefix,
+                        "       " + " ".join(error.cmd),
+                    )
+                else:
+                    console_print(
+                        self.destination.get("remote_host"),
+                        self.prefix,
+                        "ERROR: " + error.output,
+                    )
+
+                return False
+        return True
+
+    def stage(self, name):
+        """Start timing stage, ending the current stage"""
+        now = time.monotonic()
+        if self.current_stage:
+            self.timings[self.current_stage] = round(now - self.stage_started, 4)
+        self.current_stage = name
+        self.stage_started = now
+
+    def run(self):
+        """Sync and write trace record, then let the followers apply the same changes"""
+        try:
+            self.sync()
+        except Exception:
+            self.result = "error"
+            raise
+        finally:
+            self.stage(None)
+            self.engine.compression.observe(self.engine.trace.write(self))
+            self.update_journal()
+            if self.result == "ok" and not self.dry_run():
+                self.engine.drift.forget(self.native_path, self.destination.key)
+            if self.followers:
+                self.fan_out()
+
+    def update_journal(self):
+        """Keep changes that couldn't be sent in the journal until the destination is reachable, forget sent ones"""
+        if not self.config.get("offline_journal", True) or self.dry_run():
+            return
+        if self.result == "ok":
+            self.engine.journal.done(self.native_path, self.destination, self.specific_paths)
+            # The host is reachable, so send what is still waiting for it
+            host = self.destination.host_key
+            if self.engine.journal.pending(host):
+                self.engine.replay(host)
+        elif self.result == "unreachable" or self.offline:
+            self.engine.journal.add(self.native_path, self.destination, self.specific_paths)
+        elif self.replay and self.result != "cancelled":
+            # Retrying would fail the same way on every sync to the host, so the changes are given up on
+            self.engine.journal.done(self.native_path, self.destination, self.specific_paths)
+            console_print(
+                self.destination.get("remote_host"),
+                self.prefix,
+                "Dropping changes made while offline from the journal, syncing them failed (" + self.result + ").",
+            )
+
+    def cancel(self):
+        """Stop sync, killing the running rsync - the followers are cancelled as well"""
+        with self.process_lock:
+            self.cancelled = True
+            if self.process is not None and self.process.poll() is None:
+                self.process.kill()
+        for job in self.followers + self.shards:
+            job.cancel()
+
+    def track(self, process):
+        """Remember the running rsync, killing it right away if the sync was cancelled meanwhile"""
+        with self.process_lock:
+            self.process = process
+            if self.cancelled:
+                process.kill()
+
+    def fan_out(self):
+        """Apply the batch written by this sync to the followers in parallel, those that can't use it sync normally"""
+        batch_path = None
+        if self.result == "ok" and self.batch_dir and os.path.exists(os.path.join(self.batch_dir, "batch")):
+            batch_path = os.path.join(self.batch_dir, "batch")
+
+        tasks = []
+        for follower in self.followers:
+            follower.specific_paths = self.specific_paths
+            follower.queued_at = self.queued_at
+            destination_string = follower.destination.key
+            # Saved files are checked by rsync when the batch is applied, full syncs need matching manifests
+            if batch_path and (self.specific_paths or destination_string in self.consistent):
+                follower.batch_path = batch_path
+                follower.batch_options = self.options
+                follower.sent_entries = self.sent_entries
+                if self.manifest_entries is not None:
+                    follower.manifest = self.engine.manifests.get(follower.local_path, destination_string)
+                    follower.manifest_entries = self.manifest_entries
+                if self.decisions.get("manifest"):
+                    follower.decisions["manifest"] = self.decisions["manifest"]
+            tasks.append((follower.destination.get("remote_host"), follower.run, ()))
+        # The followers count towards the worker limits, like any other sync
+        self.engine.scheduler.run_all(tasks)
+
+        if self.batch_dir:
+            shutil.rmtree(self.batch_dir, ignore_errors=True)
+
+    def transfer(self, source_path, destination_path):
+        """Run rsync, streaming output to the reporter as it arrives"""
+        rsync_command = [
+            self.config.rsync_command,
+            "-v",
+            "-ar",
+            "--stats",
+            "-e",
+            " ".join(self.ssh_command_with_default_args()),
+        ]
+
+        # Compress using the best algorithm both ends support, unless the link is fast enough without
+        compression, self.decisions["compression"] = self.engine.compression.choose(
+            self.config, self.destination, self.options, self.local_capabilities(), self.host
+        )
+        rsync_command.extend(compression)
+
+        # Report overall progress, if the local rsync supports it
+        if self.config.get("progress", True) and self.local_capabilities()["protocol"] >= 31:
+            rsync_command.append("--info=progress2")
+
+        # We allow options to be specified as "--foo bar" in the config so we need to split all options on first space after the option name
+        for option in self.options:
+            if "=" not in option:
+                rsync_command.extend(option.split(" ", 1))
+            else:
+                rsync_command.append(option)
+
+        rsync_command.extend(
+            [
+                source_path,
+                build_rsync_target_string(self.destination, destination_path),
+            ]
+        )
+
+        # Add excludes, using a file that stays the same as long as the excludes do
+        matcher = compile_excludes(self.excludes)
+        exclude_path = matcher.write(os.path.join(self.engine.cache_dir, "excludes"))
+        if exclude_path and is_windows():
+            exclude_path = check_output(["cygpath", exclude_path]).strip()
+        if exclude_path:
+            rsync_command.append("--exclude-from=" + exclude_path)
+        else:
+            rsync_command.extend("--exclude=" + exclude for exclude in matcher.patterns)
+
+        # Record the transfer, so it can be applied to identical destinations without computing it again
+        if self.followers and not self.dry_run():
+            self.batch_dir = tempfile.mkdtemp(prefix="rsync-ssh-batch-")
+            batch_path = os.path.join(self.batch_dir, "batch")
+            if is_windows():
+                batch_path = check_output(["cygpath", batch_path]).strip()
+            rsync_command.append("--write-batch=" + batch_path)
+
+        # Add list of files to sync, when syncing a batch of saved files or the changes found using the manifest
+        files_from_path = None
+        if self.files_from:
+            with tempfile.NamedTemporaryFile("w", prefix="rsync-ssh-", suffix=".files", delete=False) as files_from_file:
+                files_from_file.write("\n".join(self.files_from) + "\n")
+            files_from_path = files_from_file.name
+            if is_windows():
+                files_from_path = check_output(["cygpath", files_from_path]).strip()
+            rsync_command.append("--files-from=" + files_from_path)
+
+        rsync_path_prefix = self.config.rsync_path_prefix.rstrip() + " "
+
+        # Add mkdir unless we have a --dry-run flag
+        if not self.dry_run():
+            rsync_command.extend(
+                [
+                    "--rsync-path",
+                    rsync_path_prefix
+                    + "mkdir -p '"
+                    + os.path.dirname(destination_path)
+                    + "' && "
+                    + rsync_path_prefix
+                    + self.rsync_path,
+                ]
+            )
+
+        # Show actual rsync command in the console
+        console_print(
+            self.destination.get("remote_host"),
+            self.prefix,
+            " ".join(shlex.quote(a) for a in rsync_command),
+        )
+
+        # Execute rsync, streaming output to the reporter as it arrives
+        remote_host = self.destination.get("remote_host")
+        progress_key = "00001_rsync_ssh_progress_" + self.destination.key
+
+        # Fix rsync output to include relative remote path
+        destination_file_basename = None
+        if self.specific_path and os.path.isfile(self.specific_path):
+            destination_file_relative = re.sub(
+                "^" + re.escape(self.destination.get("remote_path")) + "/?",
+                "",
+                destination_path,
+            )
+            destination_file_basename = os.path.basename(destination_file_relative)
+
+        def on_line(line):
+            """Show progress in the status bar, and pass everything else on to the reporter"""
+            match = RSYNC_PROGRESS_PATTERN.match(line)
+            if match:
+                self.reporter.set_status(progress_key, remote_host + " " + match.group(2) + "% " + match.group(3))
+                return True
+            parse_rsync_stats_line(line, self.stats)
+            if self.changes is not None and self.changes.add(line):
+                return True
+            if destination_file_basename and line == destination_file_basename:
+                line = destination_file_relative
+            self.reporter.output(remote_host, self.prefix, line)
+            return False
+
+        try:
+            stream_output(rsync_command, on_line, on_start=self.track)
+            self.engine.health.success(self.destination)
+            if self.dry_run() and self.changes is None:
+                console_print(
+                    self.destination.get("remote_host"),
+                    self.prefix,
+                    "NOTICE: Nothing synced. Remove --dry-run from options to sync.",
+                )
+        except subprocess.CalledProcessError as error:
+            if self.cancelled:
+                self.result = "cancelled"
+                console_print(self.destination.get("remote_host"), self.prefix, "Cancelled.")
+                return
+            self.result = "error"
+            # ssh failed to connect
+            if error.returncode == 255:
+                self.connection_failed()
+            # Remote host might have changed, so we'll check it again next time
+            self.engine.host_cache.invalidate(self.destination)
+            self.reporter.console_show()
+            if self.dry_run() and re.search("No such file or directory", error.output, re.MULTILINE):
+                console_print(
+                    self.destination.get("remote_host"),
+                    self.prefix,
+                    "WARNING: Unable to do dry run, remote directory " + os.path.dirname(destination_path) + " does not exist.",
+                )
+            else:
+                console_print(
+                    self.destination.get("remote_host"),
+                    self.prefix,
+                    "ERROR: " + error.output + "\n",
+                )
+        finally:
+            with self.process_lock:
+                self.process = None
+            self.reporter.erase_status(progress_key)
+            if files_from_path:
+                os.unlink(files_from_file.name)
+
+    def agent_requests(self, native_path):
+        """Get requests for sending the changes using the agent, or None if they are better sent using rsync"""
+        if self.specific_path:
+            paths = [self.specific_path[len(native_path) + 1 :]] if self.specific_path.startswith(native_path + "/") else []
+        else:
+            paths = self.files_from
+        if not paths or len(paths) > self.config.get("agent_max_files", 100):
+            return None
+
+        # rsync -a preserves permissions and times, unless told otherwise
+        keep_mode = not [option for option in self.options if option in ("--no-perms", "--no-p") or option.startswith("--chmod")]
+        keep_times = not [option for option in self.options if option in ("--no-times", "--no-t")]
+
+        matcher = compile_excludes(self.excludes)
+        max_size = self.config.get("agent_max_file_size", 1000000)
+        requests = []
+        for path in paths:
+            local_file = os.path.join(native_path, path)
+            if path in self.deleted_paths:
+                requests.append(({"op": "delete", "path": path}, None))
+                continue
+            if os.path.islink(local_file):
+                return None
+            is_dir = os.path.isdir(local_file)
+            if matcher.excluded(path, is_dir):
+                continue
+            stat = os.stat(local_file)
+            if is_dir:
+                # Folders from the manifest are new folders, their contents are listed too. Otherwise rsync syncs them.
+                if self.manifest_entries is None:
+                    return None
+                requests.append(({"op": "mkdir", "path": path, "mode": stat.st_mode & 0o7777 if keep_mode else None}, None))
+                continue
+            if stat.st_size > max_size:
+                return None
+            with open(local_file, "rb") as file:
+                data = file.read()
+            request = {
+                "op": "write",
+                "path": path,
+                "mode": stat.st_mode & 0o7777 if keep_mode else None,
+                "mtime": stat.st_mtime if keep_times else None,
+            }
+            requests.append((request, data))
+        return requests
+
+    def agent_transfer(self, native_path):
+        """Send changes using the receiver agent on the remote host, returns False if they have to be sent using rsync"""
+        if self.destination.get("transport", self.config.get("transport", "rsync")) != "agent" or self.dry_run():
+            return False
+
+        try:
+            requests = self.agent_requests(native_path)
+        except (IOError, OSError):
+            requests = None
+        if requests is None:
+            self.decisions["transport"] = "rsync"
+            return False
+
+        agent = self.engine.agents.get(
+            self.destination,
+            self.ssh_command_with_default_args(),
+            self.destination.host_string,
+            self.config.get("agent_python", "python3"),
+            self.config.rsync_path_prefix,
+        )
+        if agent is None:
+            self.decisions["transport"] = "rsync"
+            return False
+
+        remote_host = self.destination.get("remote_host")
+        try:
+            answers = agent.apply(requests)
+        except AgentError as error:
+            # Agent can't run on this host, so we use rsync for a while
+            console_print(remote_host, self.prefix, "Agent failed, falling back to rsync. " + str(error))
+            self.engine.agents.fail(self.destination)
+            self.decisions["transport"] = "rsync"
+            return False
+
+        self.decisions["transport"] = "agent"
+        self.stats = {"files_transferred": 0, "literal_bytes": 0}
+        for (request, data), answer in zip(requests, answers):
+            if not answer.get("ok"):
+                self.result = "error"
+                self.reporter.console_show()
+                console_print(remote_host, self.prefix, "ERROR: " + request["path"] + ": " + answer.get("error", ""))
+                continue
+            if request["op"] == "delete":
+                self.reporter.output(remote_host, self.prefix, "deleting " + request["path"])
+            elif request["op"] == "write":
+                self.reporter.output(remote_host, self.prefix, request["path"])
+                self.stats["files_transferred"] += 1
+                self.stats["literal_bytes"] += len(data)
+        return True
+
+    def local_capabilities(self):
+        """Get capabilities of the local rsync"""
+        return local_rsync_capabilities(self.config.rsync_command)
+
+    def dry_run(self):
+        """Check if rsync is only doing a dry run"""
+        return len([option for option in self.options if "--dry-run" in option]) != 0
+
+    def remote_command(self, name, coalesced=1):
+        """Run remote pre or post command in the remote path, returns the result"""
+        command = self.destination.get("remote_" + name)
+        ssh_command = self.ssh_command_with_default_args()
+        ssh_command.extend(
+            [
+                self.destination.host_string,
+                '$SHELL -l -c "LANG=C cd \\"' + self.destination.get("remote_path") + '\\" && ' + command + '"',
+            ]
+        )
+        label = name.replace("_", " ")
+        message = "Running " + label + ": " + command
+        if coalesced > 1:
+            message += " (" + str(coalesced) + " syncs)"
+        console_print(self.destination.get("remote_host"), self.prefix, message)
+
+        started = time.time()
+        result = "ok"
+        try:
+            output = check_output(ssh_command, stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+            if output:
+                output = re.sub(r"\n$", "", output)
+                console_print(self.destination.get("remote_host"), self.prefix, output)
+        except subprocess.CalledProcessError as error:
+            self.reporter.console_show()
+            console_print(self.destination.get("remote_host"), self.prefix, "ERROR: " + error.output + "\n")
+            result = "error"
+        console_print(
+            self.destination.get("remote_host"),
+            self.prefix,
+            label.capitalize() + " finished in " + "%.2fs" % (time.time() - started),
+        )
+        return result
+
+    def deferred_command(self, name, coalesced):
+        """Run debounced remote command after the sync is done, recording its runtime in the trace log"""
+        started = time.time()
+        result = self.remote_command(name, coalesced)
+        self.engine.trace.write_hook(self, name, result, time.time() - started, coalesced)
+        return result
+
+    def hook(self, name):
+        """Run remote pre or post command, runs never overlap for the same destination"""
+        key = (name, self.destination.key)
+        delay = 0
+        if name == "post_command":
+            delay = self.destination.get("post_command_delay", self.config.get("post_command_delay", 0)) / 1000.0
+
+        if delay > 0:
+            self.decisions[name] = "debounced"
+            self.engine.hooks.request(key, lambda coalesced: self.deferred_command(name, coalesced), delay, False)
+            return
+        self.stage(name)
+        self.engine.hooks.request(key, lambda coalesced: self.remote_command(name, coalesced))
+
+    def apply_batch(self, destination_path):
+        """Apply batch written by the leader with rsync --read-batch on the remote host, returns False if it failed"""
+        rsync_path_prefix = self.config.rsync_path_prefix.rstrip() + " "
+        options = []
+        for option in self.batch_options:
+            options.extend(option.split(" ", 1) if "=" not in option else [option])
+        remote_command = (
+            rsync_path_prefix
+            + "mkdir -p "
+            + shlex.quote(os.path.dirname(destination_path))
+            + " && "
+            + rsync_path_prefix
+            + self.rsync_path
+            + " --read-batch=- -a "
+            + " ".join(shlex.quote(option) for option in options)
+            + " "
+            + shlex.quote(destination_path)
+        )
+        command = self.ssh_command_with_default_args() + [self.destination.host_string, remote_command]
+        console_print(self.destination.get("remote_host"), self.prefix, "Applying batch: " + remote_command)
+
+        try:
+            with open(self.batch_path, "rb") as batch_file:
+                output = check_output(command, stdin=batch_file, stderr=subprocess.STDOUT)
+        except (subprocess.CalledProcessError, OSError) as error:
+            console_print(
+                self.destination.get("remote_host"),
+                self.prefix,
+                "Destination differs from the others, syncing it separately: " + str(getattr(error, "output", error)).strip(),
+            )
+            self.decisions["fan_out"] = "fallback"
+            self.manifest_entries = None
+            self.decisions.pop("manifest", None)
+            return False
+
+        if output.strip():
+            console_print(self.destination.get("remote_host"), self.prefix, output.strip())
+        self.decisions["fan_out"] = "batch"
+        return True
+
+    def plan_full_sync(self, native_path):
+        """Use the manifest to only send what changed since the last full sync, returns False if nothing changed"""
+        if not self.config.get("manifest", True) or self.dry_run():
+            return True
+
+        self.stage("scan")
+        self.manifest = self.engine.manifests.get(native_path, self.destination.key)
+        self.manifest_entries = scan(native_path, self.excludes)
+
+        # Fall back to a full rsync when we have no manifest, or it is time to check everything again
+        if self.manifest.due(self.config.get("manifest_reconcile_interval", 86400)):
+            self.decisions["manifest"] = "reconcile"
+            return True
+
+        changed, deleted = self.manifest.diff(native_path, self.manifest_entries, self.config.get("manifest_hash", False))
+
+        # Followers only get the same changes, so their manifest must be the same as ours
+        for follower in self.followers:
+            destination_string = follower.destination.key
+            manifest = self.engine.manifests.get(native_path, destination_string)
+            if manifest.load() and manifest.entries == self.manifest.entries:
+                self.consistent.add(destination_string)
+
+        # Deleted files are only deleted on the destination when rsync is told to delete, and supports it for --files-from
+        if deleted and len([option for option in self.options if option.startswith("--delete")]) == 0:
+            deleted = []
+        elif deleted and min(self.host.get("protocol", 0), self.local_capabilities()["protocol"]) < 31:
+            self.decisions["manifest"] = "reconcile"
+            return True
+
+        self.decisions["manifest"] = {"changed": len(changed), "deleted": len(deleted)}
+        if not changed and not deleted:
+            return False
+
+        self.files_from = changed + deleted
+        self.deleted_paths = deleted
+        if deleted:
+            self.options = self.options + ["--delete-missing-args", "--force"]
+        return True
+
+    def update_manifest(self, native_path):
+        """Record what was sent in the manifest, after a successful sync"""
+        if self.result != "ok" or self.dry_run() or not self.config.get("manifest", True):
+            return
+
+        use_hash = self.config.get("manifest_hash", False)
+        if self.manifest_entries is not None:
+            reconciled = self.decisions.get("manifest") == "reconcile"
+            self.manifest.replace(native_path, self.manifest_entries, use_hash, reconciled)
+            return
+
+        # Saved files are recorded as well, so the next full sync won't send them again
+        manifest = self.engine.manifests.get(native_path, self.destination.key)
+        for entries, subdir in self.sent_entries:
+            manifest.update(entries, subdir, self.deleted_paths if self.preview is not None else ())
+
+    def snapshot(self, native_path):
+        """Get manifest entries of the saved files before sending them.
+
+        A file changed while it is being sent is only recorded as the version that was sent, so the next full sync
+        sends it again.
+        """
+        if self.manifest_entries is not None or not self.config.get("manifest", True):
+            return
+        if self.preview is not None:
+            self.sent_entries = [(Manifest.stat(native_path, self.files_from, self.excludes), "")]
+            return
+        paths = [path[len(native_path) + 1 :] for path in self.specific_paths if path.startswith(native_path + "/")]
+        self.sent_entries = [
+            (scan(native_path, self.excludes, subdir), subdir)
+            for subdir in paths
+            if os.path.isdir(os.path.join(native_path, subdir))
+        ]
+        self.sent_entries.append((Manifest.stat(native_path, paths, self.excludes), ""))
+
+    def sync(self):
+        """Run all the stages of the sync"""
+        native_path = self.local_path
+
+        # A single path is synced directly, multiple paths are sent using --files-from, relative to the local path
+        if len(self.specific_paths) == 1:
+            self.specific_path = self.specific_paths[0]
+        elif self.specific_paths:
+            self.files_from = [
+                path[len(self.local_path) + 1 :] for path in self.specific_paths if path.startswith(self.local_path + "/")
+            ]
+
+        # Cygwin version of rsync is assumed on Windows. Local path needs to be converted using cygpath.
+        if is_windows():
+            try:
+                self.local_path = check_output(["cygpath", self.local_path]).strip()
+                if self.specific_path:
+                    self.specific_path = check_output(["cygpath", self.specific_path]).strip()
+            except subprocess.CalledProcessError as error:
+                self.reporter.console_show()
+                console_print(
+                    self.destination.get("remote_host"),
+                    self.prefix,
+                    "ERROR: Failed to run cygpath to convert local file path. Can't continue.",
+                )
+                console_print(
+                    self.destination.get("remote_host"),
+                    self.prefix,
+                    error.output,
+                )
+                self.result = "error"
+                return
+
+        # Skip disabled destinations, unless we explicitly force a sync (e.g. for specific destinations)
+        if not self.force_sync and not self.destination.get("enabled", 1):
+            console_print(
+                self.destination.get("remote_host"),
+                self.prefix,
+                "Skipping, destination is disabled.",
+            )
+            self.result = "skipped"
+            return
+
+        # Fail fast when the host is down, instead of waiting for the connect timeout every time
+        if not self.engine.health.allow(self.destination):
+            console_print(
+                self.destination.get("remote_host"),
+                self.prefix,
+                "Skipping, host is down - checking again in " + str(self.engine.health.retry_in(self.destination)) + "s.",
+            )
+            self.result = "unreachable"
+            return
+
+        # What to rsync
+        source_path = self.local_path + "/"
+        destination_path = self.destination.get("remote_path")
+
+        # Handle specific path syncs (e.g. save events and specific remote)
+        if self.specific_path and os.path.isfile(self.specific_path) and self.specific_path.startswith(self.local_path + "/"):
+            source_path = self.specific_path
+            destination_path = self.destination.get("remote_path") + self.specific_path.replace(self.local_path, "")
+        elif self.specific_path and os.path.isdir(self.specific_path) and self.specific_path.startswith(self.local_path + "/"):
+            source_path = self.specific_path + "/"
+            destination_path = self.destination.get("remote_path") + self.specific_path.replace(self.local_path, "")
+        elif self.files_from:
+            destination_path = self.destination.get("remote_path") + "/"
+
+        # Cancelled before it started, so we don't contact the host at all
+        if self.cancelled:
+            self.result = "cancelled"
+            return
+
+        # Get path of rsync on the remote host, checking the ssh connection if we don't know it already
+        self.stage("check")
+        if not self.check_host():
+            self.result = "error"
+            return
+
+        # Remote pre command, a run already in progress for the destination is finished first - previews don't run it
+        if self.destination.get("remote_pre_command") and self.changes is None:
+            self.hook("pre_command")
+
+        # Followers apply the batch written by the leader, falling back to a normal sync if it doesn't apply
+        send = True
+        if self.batch_path:
+            self.stage("transfer")
+            send = not self.apply_batch(destination_path)
+            if not send:
+                self.update_manifest(native_path)
+
+        # Previews send exactly the changes found by their dry run, full syncs the files changed since the last full sync
+        if self.preview is not None:
+            send = plan_preview(self)
+            destination_path = self.destination.get("remote_path") + "/"
+        elif send and not self.specific_paths:
+            send = self.plan_full_sync(native_path)
+            if self.files_from:
+                destination_path = self.destination.get("remote_path") + "/"
+
+        # A newer sync superseded this one while the pre command ran, the post command still runs to match it
+        if self.cancelled:
+            self.result = "cancelled"
+            send = False
+
+        if send:
+            self.snapshot(native_path)
+            self.stage("transfer")
+            # Empty destinations get the whole tree as a tar stream, large trees can be split into shards sent at the same time
+            whole_tree = not self.specific_paths and not self.files_from and not self.dry_run()
+            shards = self.destination.get("shards", self.config.get("shards", 1))
+            if whole_tree and tar_transfer(self, native_path):
+                console_print(
+                    self.destination.get("remote_host"),
+                    self.prefix,
+                    "Sent " + str(self.stats.get("files_transferred", 0)) + " files, later syncs use rsync.",
+                )
+            elif whole_tree and shards > 1:
+                sharded_transfer(self, native_path, shards)
+            # The leader of identical destinations always uses rsync, so it can write a batch for the others
+            elif self.followers or not self.agent_transfer(native_path):
+                self.transfer(source_path, destination_path)
+            self.update_manifest(native_path)
+        elif self.result != "cancelled" and self.decisions.get("fan_out") != "batch":
+            console_print(self.destination.get("remote_host"), self.prefix, "Nothing changed since last sync.")
+
+        # Remote post command, bursts of syncs are collapsed into a single run when post_command_delay is set
+        if self.destination.get("remote_post_command") and self.changes is None:
+            self.hook("post_command")
+
+        # End of run
+        return
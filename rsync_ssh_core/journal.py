@@ -0,0 +1,110 @@
+"""Journal of changes that couldn't be synced because the destination was unreachable, kept on disk."""
+import json
+import os
+import threading
+
+from .util import build_rsync_destination_string, build_ssh_destination_string, console_print
+
+
+class ChangeJournal(object):
+    """Pending changes per (local path, destination), persisted so they survive restarts.
+
+    Repeated saves of the same path are only recorded once, and a full sync replaces the paths recorded before it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(local_path, destination):
+        """Journal key for local path and destination"""
+        return local_path + "\t" + build_rsync_destination_string(destination)
+
+    def load(self):
+        """Load journal from disk, must be called with the lock held"""
+        if self.entries is not None:
+            return
+        try:
+            with open(self.path, "r") as journal_file:
+                self.entries = json.load(journal_file)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        """Write journal to disk, must be called with the lock held"""
+        try:
+            if not self.entries:
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                return
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path + ".tmp", "w") as journal_file:
+                json.dump(self.entries, journal_file, indent=4, sort_keys=True)
+            os.replace(self.path + ".tmp", self.path)
+        except (IOError, OSError) as error:
+            console_print("", "", "Unable to save change journal: " + str(error))
+
+    def add(self, local_path, destination, paths):
+        """Record paths that couldn't be synced to destination, no paths means a full sync"""
+        key = self.key(local_path, destination)
+        with self.lock:
+            self.load()
+            entry = self.entries.setdefault(
+                key,
+                {
+                    "local_path": local_path,
+                    "destination": build_rsync_destination_string(destination),
+                    "host": build_ssh_destination_string(destination),
+                    "full": False,
+                    "paths": [],
+                },
+            )
+            if not paths:
+                entry["full"] = True
+                entry["paths"] = []
+            elif not entry["full"]:
+                entry["paths"] = sorted(set(entry["paths"]) | set(paths))
+            self.save()
+
+    def done(self, local_path, destination, paths):
+        """Forget paths synced to destination, no paths means a full sync"""
+        self.discard(local_path, build_rsync_destination_string(destination), paths)
+
+    def discard(self, local_path, destination_string, paths):
+        """Forget paths for destination given as (user@)host(:port):path, no paths means everything"""
+        key = local_path + "\t" + destination_string
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            if not paths:
+                del self.entries[key]
+            elif not entry["full"]:
+                entry["paths"] = sorted(set(entry["paths"]) - set(paths))
+                if not entry["paths"]:
+                    del self.entries[key]
+            else:
+                return
+            self.save()
+
+    def pending(self, host=None):
+        """Get list of pending entries, optionally only those for a single (user, host, port)"""
+        with self.lock:
+            self.load()
+            return [dict(entry) for entry in self.entries.values() if host is None or entry["host"] == host]
+
+
+change_journals = {}
+change_journals_lock = threading.Lock()
+
+
+def change_journal(path):
+    """Get the change journal stored at path, shared by everyone using the same file"""
+    with change_journals_lock:
+        if path not in change_journals:
+            change_journals[path] = ChangeJournal(path)
+        return change_journals[path]
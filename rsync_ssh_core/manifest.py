@@ -0,0 +1,209 @@
+"""Manifest of what was last synced to a destination, so a full sync only has to send what changed since."""
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import threading
+import time
+
+from .excludes import compile_excludes
+from .util import console_print
+
+MANIFEST_VERSION = 1
+
+# Entry for directories, files are stored as [size, mtime in ns, hash or None]
+DIRECTORY = "d"
+
+
+def file_hash(path):
+    """Hash file contents"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan(local_path, excludes, subdir=""):
+    """Walk local tree (or subdir of it) and get entries for all files and directories not excluded"""
+    matcher = compile_excludes(excludes)
+    entries = {}
+    top = os.path.join(local_path, subdir) if subdir else local_path
+    for root, dirs, files in os.walk(top):
+        relative_root = os.path.relpath(root, local_path).replace(os.sep, "/")
+        relative_root = "" if relative_root == "." else relative_root + "/"
+
+        # Prune excluded directories, so we don't walk them
+        for name in list(dirs):
+            if matcher.matches(relative_root + name, True):
+                dirs.remove(name)
+            else:
+                entries[relative_root + name] = DIRECTORY
+
+        for name in files:
+            if matcher.matches(relative_root + name, False):
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                # Removed while we were walking
+                continue
+            entries[relative_root + name] = [stat.st_size, stat.st_mtime_ns, None]
+    return entries
+
+
+def partition(entries, count, file_cost=65536):
+    """Split entries into count lists of relative paths, balanced by file count and bytes.
+
+    Each entry weighs its size plus file_cost, as every file costs a round trip regardless of its size. The
+    heaviest entries are placed first, each on the lightest partition so far.
+    """
+    weighted = sorted(((entry[0] if entry != DIRECTORY else 0) + file_cost, path) for path, entry in entries.items())
+    partitions = [[] for _ in range(count)]
+    loads = [(0, number) for number in range(count)]
+    for weight, path in reversed(weighted):
+        load, number = heapq.heappop(loads)
+        partitions[number].append(path)
+        heapq.heappush(loads, (load + weight, number))
+    return [sorted(paths) for paths in partitions]
+
+
+class Manifest(object):
+    """Path, size, mtime and optional content hash of every file last synced to a destination"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        self.reconciled_at = 0
+
+    def load(self):
+        """Load manifest from disk, returns False if there is no usable manifest"""
+        if self.entries is not None:
+            return True
+        try:
+            with gzip.open(self.path, "rt") as manifest_file:
+                data = json.load(manifest_file)
+        except (IOError, OSError, ValueError, EOFError):
+            return False
+        if data.get("version") != MANIFEST_VERSION:
+            return False
+        self.entries = data.get("entries", {})
+        self.reconciled_at = data.get("reconciled_at", 0)
+        return True
+
+    def save(self):
+        """Write manifest to disk"""
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            data = {"version": MANIFEST_VERSION, "reconciled_at": self.reconciled_at, "entries": self.entries}
+            with gzip.open(self.path + ".tmp", "wt") as manifest_file:
+                json.dump(data, manifest_file, separators=(",", ":"))
+            os.replace(self.path + ".tmp", self.path)
+        except (IOError, OSError) as error:
+            console_print("", "", "Unable to save manifest: " + str(error))
+
+    def due(self, interval):
+        """Check if a full reconciliation is due, i.e. we have no manifest or it is older than interval seconds"""
+        return not self.load() or time.time() - self.reconciled_at >= interval
+
+    def diff(self, local_path, current, use_hash=False):
+        """Get changed and deleted paths, relative to local_path, by comparing current entries to the manifest.
+
+        Hashes are only computed for files whose size or mtime changed, a file with unchanged contents is not sent.
+        """
+        changed = []
+        for path, entry in current.items():
+            previous = self.entries.get(path)
+            if entry == DIRECTORY:
+                if previous != DIRECTORY:
+                    changed.append(path)
+                continue
+            if previous is not None and previous != DIRECTORY and previous[:2] == entry[:2]:
+                entry[2] = previous[2]
+                continue
+            if use_hash and previous is not None and previous != DIRECTORY and previous[2]:
+                try:
+                    entry[2] = file_hash(os.path.join(local_path, path))
+                except (IOError, OSError):
+                    pass
+                if entry[2] == previous[2]:
+                    continue
+            changed.append(path)
+
+        # Only the topmost of deleted directories are needed, deleting them removes everything below
+        deleted = []
+        for path in sorted(path for path in self.entries if path not in current):
+            if deleted and path.startswith(deleted[-1] + "/"):
+                continue
+            deleted.append(path)
+
+        return sorted(changed), deleted
+
+    def replace(self, local_path, entries, use_hash=False, reconciled=False):
+        """Replace entries with those scanned before a successful sync, of everything when reconciled or just the changes"""
+        if use_hash:
+            self.hash_entries(local_path, entries)
+        self.entries = entries
+        if reconciled:
+            self.reconciled_at = time.time()
+        self.save()
+
+    def update(self, entries, subdir="", removed=()):
+        """Replace entries for the given paths, or everything below subdir, and drop removed paths after a successful sync"""
+        if not self.load():
+            return
+        if subdir:
+            for path in [path for path in self.entries if path.startswith(subdir + "/")]:
+                del self.entries[path]
+        for removed_path in removed:
+            for path in [path for path in self.entries if path == removed_path or path.startswith(removed_path + "/")]:
+                del self.entries[path]
+        self.entries.update(entries)
+        self.save()
+
+    @staticmethod
+    def hash_entries(local_path, entries):
+        """Compute missing content hashes"""
+        for path, entry in entries.items():
+            if entry != DIRECTORY and entry[2] is None:
+                try:
+                    entry[2] = file_hash(os.path.join(local_path, path))
+                except (IOError, OSError):
+                    pass
+
+    @staticmethod
+    def stat(local_path, paths, excludes):
+        """Get entries for paths relative to local_path, missing and excluded paths are left out"""
+        matcher = compile_excludes(excludes)
+        entries = {}
+        for path in paths:
+            if matcher.excluded(path):
+                continue
+            try:
+                stat = os.stat(os.path.join(local_path, path))
+            except OSError:
+                continue
+            if os.path.isdir(os.path.join(local_path, path)):
+                entries[path] = DIRECTORY
+            else:
+                entries[path] = [stat.st_size, stat.st_mtime_ns, None]
+        return entries
+
+
+class ManifestStore(object):
+    """Manifests of an engine, one per local path and destination"""
+
+    def __init__(self, path):
+        self.path = path
+        self.manifests = {}
+        self.lock = threading.Lock()
+
+    def get(self, local_path, destination_string):
+        """Get manifest for syncing local_path to destination"""
+        key = hashlib.sha1((local_path + "\0" + destination_string).encode("utf-8")).hexdigest()[:16]
+        with self.lock:
+            if key not in self.manifests:
+                self.manifests[key] = Manifest(os.path.join(self.path, key + ".json.gz"))
+            return self.manifests[key]
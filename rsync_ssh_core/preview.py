@@ -0,0 +1,133 @@
+"""Previews of a full sync, found by a dry run and applied later without comparing the trees again."""
+import os
+import re
+import time
+
+from .manifest import DIRECTORY
+from .util import console_print
+
+# Lines of rsync --itemize-changes output: update type, file type, attributes and path
+ITEMIZE_PATTERN = re.compile(r"^([<>ch.])([fdLDS])([^ ]{9,10}) (.+)$")
+DELETING_PATTERN = re.compile(r"^\*deleting +(.+)$")
+
+
+def local_state(path):
+    """Get what we know about path before sending it: size and mtime of a file, or None if it is missing"""
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return None
+    if os.path.isdir(path) and not os.path.islink(path):
+        return DIRECTORY
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def format_size(size):
+    """Format size in bytes for humans"""
+    if size < 1000:
+        return str(size) + " B"
+    for unit in ["kB", "MB", "GB"]:
+        size /= 1000.0
+        if size < 1000 or unit == "GB":
+            break
+    return "%.1f " % size + unit
+
+
+class ChangeSet(object):
+    """New, updated and deleted paths a full sync to a destination would send, as found by a dry run.
+
+    The local state of every path is recorded when it is found, so applying the changes can check that they are
+    still the ones that were previewed.
+    """
+
+    def __init__(self, local_path, prefix, destination):
+        self.local_path = local_path
+        self.prefix = prefix
+        self.destination = destination
+        self.new = []
+        self.updated = []
+        self.deleted = []
+        self.states = {}
+        self.previewed_at = time.time()
+
+    def add(self, line):
+        """Record change from a line of rsync output, returns False if the line is no change"""
+        match = DELETING_PATTERN.match(line)
+        if match:
+            path = match.group(1).rstrip("/")
+            self.deleted.append(path)
+            self.states[path] = None
+            return True
+
+        match = ITEMIZE_PATTERN.match(line)
+        if not match:
+            return False
+        update, file_type, attributes, path = match.groups()
+        if file_type == "L":
+            path = path.split(" -> ", 1)[0]
+        path = path.rstrip("/")
+        # Changed times of folders are a side effect of changing what is in them, and the root is never listed
+        if path in ("", ".") or (file_type == "d" and update == "."):
+            return True
+        if attributes.startswith("+"):
+            self.new.append(path)
+        else:
+            self.updated.append(path)
+        self.states[path] = local_state(os.path.join(self.local_path, path))
+        return True
+
+    def paths(self):
+        """Get all paths, relative to the local path"""
+        return self.new + self.updated + self.deleted
+
+    def size(self, path):
+        """Get size of what is sent for path"""
+        state = self.states.get(path)
+        return state[0] if state and state != DIRECTORY else 0
+
+    def stale(self):
+        """Get paths that changed locally since they were previewed"""
+        return [path for path, state in self.states.items() if local_state(os.path.join(self.local_path, path)) != state]
+
+    def summary(self):
+        """Describe the changes, a line per path"""
+        lines = [
+            self.destination.key
+            + ": "
+            + str(len(self.new))
+            + " new, "
+            + str(len(self.updated))
+            + " updated, "
+            + str(len(self.deleted))
+            + " deleted, "
+            + format_size(sum(self.size(path) for path in self.new + self.updated))
+            + " to send"
+        ]
+        for mark, paths in [("+", self.new), ("~", self.updated)]:
+            for path in paths:
+                detail = "/" if self.states[path] == DIRECTORY else " (" + format_size(self.size(path)) + ")"
+                lines.append("    " + mark + " " + path + detail)
+        for path in self.deleted:
+            lines.append("    - " + path)
+        return lines
+
+
+def plan_preview(job):
+    """Send the paths of the applied preview and nothing else, returns False if there is nothing to send"""
+    deleted = job.preview.deleted
+    if deleted and min(job.host.get("protocol", 0), job.local_capabilities()["protocol"]) < 31:
+        console_print(
+            job.destination.get("remote_host"),
+            job.prefix,
+            "Not deleting " + str(len(deleted)) + " files, this needs rsync 3.1 or later on both ends.",
+        )
+        deleted = []
+
+    job.decisions["preview"] = {"changed": len(job.preview.new + job.preview.updated), "deleted": len(deleted)}
+    job.files_from = job.preview.new + job.preview.updated + deleted
+    job.deleted_paths = deleted
+    # Folders are created, but not recursed into - their contents are listed if they were previewed
+    job.options = job.options + ["--no-r"]
+    if deleted:
+        job.options = job.options + ["--delete-missing-args", "--force"]
+    return bool(job.files_from)
@@ -0,0 +1,131 @@
+"""Receiver agent, run on the remote host when a destination uses the agent transport.
+
+The source of this module is sent over ssh and run by the remote python, so it must only use the standard library
+and must not import anything from rsync_ssh_core. It reads framed requests from stdin and answers each of them on
+stdout, a frame is a 4 byte big endian length followed by that many bytes. Each request is a JSON frame, a write is
+followed by a frame with the file contents.
+"""
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+VERSION = 1
+FRAME_HEADER = struct.Struct(">I")
+
+
+def read_exactly(stream, size):
+    """Read size bytes from stream"""
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError("stream closed")
+        data += chunk
+    return data
+
+
+def read_frame(stream):
+    """Read a single frame"""
+    (size,) = FRAME_HEADER.unpack(read_exactly(stream, FRAME_HEADER.size))
+    return read_exactly(stream, size)
+
+
+def write_frame(stream, data):
+    """Write a single frame"""
+    stream.write(FRAME_HEADER.pack(len(data)) + data)
+
+
+def resolve(root, path):
+    """Get absolute path of path relative to root, refusing paths outside root"""
+    full_path = os.path.normpath(os.path.join(root, path))
+    if full_path != root and not full_path.startswith(root.rstrip("/") + "/"):
+        raise ValueError("Path outside destination: " + path)
+    return full_path
+
+
+def write(root, request, data, umask):
+    """Write file atomically, creating missing folders"""
+    path = resolve(root, request["path"])
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".rsync-ssh-")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+        mode = request.get("mode")
+        os.chmod(temp_path, mode if mode is not None else 0o666 & ~umask)
+        if request.get("mtime") is not None:
+            os.utime(temp_path, (request["mtime"], request["mtime"]))
+        os.rename(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def delete(root, request):
+    """Delete file or folder, a missing path is not an error"""
+    path = resolve(root, request["path"])
+    if path == root:
+        raise ValueError("Refusing to delete the destination itself")
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def mkdir(root, request):
+    """Create folder and its parents"""
+    path = resolve(root, request["path"])
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if request.get("mode") is not None:
+        os.chmod(path, request["mode"])
+
+
+def main():
+    """Answer requests until stdin is closed or we are told to exit"""
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    umask = os.umask(0)
+    os.umask(umask)
+    root = None
+
+    while True:
+        try:
+            request = json.loads(read_frame(stdin).decode("utf-8"))
+        except EOFError:
+            return 0
+        data = read_frame(stdin) if request.get("op") == "write" else None
+
+        response = {"ok": True}
+        try:
+            if request["op"] == "hello":
+                root = os.path.normpath(os.path.expanduser(request["root"]))
+                response["version"] = VERSION
+            elif request["op"] == "exit":
+                root = None
+            elif root is None:
+                raise ValueError("Missing hello")
+            elif request["op"] == "write":
+                write(root, request, data, umask)
+            elif request["op"] == "delete":
+                delete(root, request)
+            elif request["op"] == "mkdir":
+                mkdir(root, request)
+            else:
+                raise ValueError("Unknown operation: " + str(request["op"]))
+        except (OSError, IOError, ValueError, KeyError) as error:
+            response = {"ok": False, "error": str(error)}
+
+        write_frame(stdout, json.dumps(response).encode("utf-8"))
+        stdout.flush()
+        if request.get("op") == "exit":
+            return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
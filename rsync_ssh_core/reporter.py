@@ -0,0 +1,23 @@
+"""Reporting of sync progress, the editor plugin provides its own reporter."""
+from .util import console_print
+
+
+class Reporter(object):
+    """Receives status updates from the sync engine, by default only output and messages are printed"""
+
+    def console_show(self):
+        """Called on errors, so the user gets to see them"""
+
+    def set_status(self, key, value):
+        """Show status, e.g. in the status bar"""
+
+    def erase_status(self, key):
+        """Remove status"""
+
+    def status_message(self, message):
+        """Show short lived message"""
+        console_print("", "", message)
+
+    def output(self, host, prefix, line):
+        """Show a line of output from rsync"""
+        console_print(host, prefix, line)
@@ -0,0 +1,143 @@
+"""Bounded worker pool shared by all syncs."""
+import collections
+import threading
+
+
+class SyncScheduler(object):
+    """Bounded pool of worker threads, with a limit on the number of concurrent jobs per host"""
+
+    # Idle workers exit after this many seconds
+    idle_timeout = 30
+
+    def __init__(self, max_workers=4, max_workers_per_host=2):
+        self.max_workers = max_workers
+        self.max_workers_per_host = max_workers_per_host
+        self.jobs = collections.deque()
+        self.running = {}
+        self.workers = 0
+        self.idle_workers = 0
+        self.condition = threading.Condition()
+        # Host of the job run by the current worker thread, see run_all()
+        self.local = threading.local()
+
+    def configure(self, max_workers, max_workers_per_host):
+        """Update worker limits"""
+        with self.condition:
+            self.max_workers = max(1, max_workers)
+            self.max_workers_per_host = max(1, max_workers_per_host)
+            self.condition.notify_all()
+        self.start_workers()
+
+    def submit(self, host, function, *args):
+        """Queue function to be run by a worker when host has a free slot"""
+        with self.condition:
+            self.jobs.append((host, function, args))
+            self.condition.notify()
+        self.start_workers()
+
+    def run_all(self, tasks):
+        """Run list of (host, function, args) using the workers, and wait until they are all done.
+
+        When called from a job, the host slot of that job is given up while waiting, and the waiting worker runs
+        the tasks itself when their host has a free slot - so jobs waiting for their own tasks can't use up all
+        the workers.
+        """
+        remaining = [len(tasks)]
+
+        def task(function, args):
+            """Run function and count it as done"""
+            try:
+                function(*args)
+            finally:
+                with self.condition:
+                    remaining[0] -= 1
+                    self.condition.notify_all()
+
+        jobs = [(host, task, (function, args)) for host, function, args in tasks]
+        worker = getattr(self.local, "worker", False)
+        with self.condition:
+            self.jobs.extend(jobs)
+            if worker and self.local.host is not None:
+                self.release(self.local.host)
+                self.local.host = None
+            self.condition.notify_all()
+        self.start_workers()
+
+        with self.condition:
+            while remaining[0]:
+                job = self.next_job(jobs) if worker else None
+                if job is None:
+                    self.condition.wait()
+                    continue
+                self.condition.release()
+                try:
+                    self.run_job(job)
+                finally:
+                    self.condition.acquire()
+
+    def queue_depth(self):
+        """Number of jobs waiting for a worker"""
+        with self.condition:
+            return len(self.jobs)
+
+    def start_workers(self):
+        """Start new workers, if there are more jobs than idle workers and we are below the limit"""
+        with self.condition:
+            missing = min(len(self.jobs) - self.idle_workers, self.max_workers - self.workers)
+            self.workers += max(0, missing)
+        for _ in range(missing):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+
+    def next_job(self, among=None):
+        """Get first job for a host with a free slot, optionally only among jobs - must be called with the condition held"""
+        for job in self.jobs:
+            if among is not None and job not in among:
+                continue
+            if self.running.get(job[0], 0) < self.max_workers_per_host:
+                self.jobs.remove(job)
+                self.running[job[0]] = self.running.get(job[0], 0) + 1
+                return job
+        return None
+
+    def worker(self):
+        """Run jobs until idle for too long"""
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None:
+                    self.idle_workers += 1
+                    notified = self.condition.wait(self.idle_timeout)
+                    self.idle_workers -= 1
+                    job = self.next_job()
+                    if job is None and (not notified or self.workers > self.max_workers):
+                        self.workers -= 1
+                        return
+
+            self.local.worker = True
+            self.run_job(job)
+
+    def run_job(self, job):
+        """Run job taken by next_job(), freeing its host slot when done - unless it gave it up while running"""
+        host, function, args = job
+        outer = getattr(self.local, "host", None)
+        self.local.host = host
+        try:
+            function(*args)
+        finally:
+            with self.condition:
+                if self.local.host is not None:
+                    self.release(host)
+                self.local.host = outer
+
+    def release(self, host):
+        """Free a slot for host, must be called with the condition held"""
+        self.running[host] -= 1
+        if not self.running[host]:
+            del self.running[host]
+        # A slot for host is free, so a job waiting for it might be runnable now
+        self.condition.notify_all()
+
+
+sync_scheduler = SyncScheduler()
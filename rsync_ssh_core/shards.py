@@ -0,0 +1,70 @@
+"""Whole tree syncs split into shards, sent by parallel rsyncs over separate ssh connections."""
+import time
+
+from .manifest import partition, scan
+from .util import console_print
+
+
+def make_shard(job, options):
+    """Get job for a part of a sharded full sync, using its own ssh connection"""
+    shard = job.__class__(
+        job.engine, job.config, job.local_path, job.prefix, job.destination, job.excludes, options, [], job.force_sync
+    )
+    shard.host = job.host
+    shard.rsync_path = job.rsync_path
+    shard.multiplex = False
+    return shard
+
+
+def sharded_transfer(job, native_path, count):
+    """Send the tree as count parts at the same time, balanced by file count and bytes.
+
+    The shards are sent using --files-from, which never deletes anything, so extraneous files on the destination
+    are deleted in a final pass that only deletes, when a --delete option is used.
+    """
+    entries = job.manifest_entries if job.manifest_entries is not None else scan(native_path, job.excludes)
+    started = time.time()
+
+    # Shards only send, deleting within a folder another shard is sending files to would delete those files
+    delete = [option for option in job.options if option.startswith("--delete")]
+    options = [option for option in job.options if option not in delete] + ["--no-r"]
+    job.shards = []
+    for paths in partition(entries, count):
+        if paths:
+            shard = make_shard(job, options)
+            shard.files_from = paths
+            job.shards.append(shard)
+
+    # The shards count against the worker limits of the host, like every other rsync
+    host = job.destination.get("remote_host")
+    remote_path = job.destination.get("remote_path") + "/"
+    job.engine.scheduler.run_all([(host, shard.transfer, (job.local_path + "/", remote_path)) for shard in job.shards])
+    shard_count = len(job.shards)
+
+    if delete and not job.cancelled and all(shard.result == "ok" for shard in job.shards):
+        final = make_shard(job, job.options + ["--existing", "--ignore-existing"])
+        job.shards.append(final)
+        final.transfer(job.local_path + "/", job.destination.get("remote_path"))
+
+    for shard in job.shards:
+        for name, value in shard.stats.items():
+            if isinstance(value, int):
+                job.stats[name] = job.stats.get(name, 0) + value
+        if shard.result != "ok":
+            job.result = "cancelled" if job.cancelled else shard.result
+
+    seconds = max(time.time() - started, 0.001)
+    throughput = job.stats.get("bytes_sent", 0) / seconds
+    job.decisions["shards"] = {"count": shard_count, "throughput": int(throughput)}
+    console_print(
+        job.destination.get("remote_host"),
+        job.prefix,
+        "Sent "
+        + str(job.stats.get("bytes_sent", 0))
+        + " bytes in "
+        + "%.1fs" % seconds
+        + " using "
+        + str(shard_count)
+        + " shards, "
+        + "%.1fMB/s" % (throughput / 1000000),
+    )
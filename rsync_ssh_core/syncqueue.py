@@ -0,0 +1,185 @@
+"""Per destination queue, coalescing bursts of changes into a single sync."""
+import os
+import threading
+import time
+
+from .util import console_print
+
+# Status bar key for the number of destinations being synced
+STATUS_KEY = "00000_rsync_ssh_status"
+
+
+class PendingSync(object):
+    """Changes waiting to be synced to a single destination"""
+
+    def __init__(self):
+        self.job = None
+        self.current = None
+        self.paths = set()
+        self.full = False
+        self.timer = None
+        self.running = False
+        self.started = False
+
+
+class SyncQueue(object):
+    """Per destination queue that coalesces bursts of saves into a single rsync"""
+
+    def __init__(self, reporter, scheduler):
+        self.reporter = reporter
+        self.scheduler = scheduler
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.busy = False
+
+    def add(self, job, delay=0):
+        """Queue job, merging it with changes already waiting for the same destination"""
+        key = (job.local_path, job.destination.key)
+
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                pending = self.pending[key] = PendingSync()
+
+            # Latest job wins, as it has the most recent settings - but latency is measured from the first save
+            if pending.job is not None:
+                job.force_sync = job.force_sync or pending.job.force_sync
+                job.replay = job.replay or pending.job.replay
+                job.queued_at = min(job.queued_at, pending.job.queued_at)
+            pending.job = job
+            if job.specific_paths:
+                pending.paths.update(job.specific_paths)
+            else:
+                pending.full = True
+
+            # Newer saves of every file the running sync is sending make it obsolete, so stop it and send them now
+            current = pending.current
+            if (
+                pending.running
+                and current is not None
+                and current.specific_paths
+                and not current.cancelled
+                and set(current.specific_paths) <= pending.paths
+            ):
+                console_print(job.destination.get("remote_host"), job.prefix, "Newer save arrived, cancelling running sync.")
+                current.cancel()
+
+            # Restart debounce timer, unless a sync is running - then we'll flush when it is done
+            if pending.timer:
+                pending.timer.cancel()
+                pending.timer = None
+            if not pending.running:
+                pending.timer = threading.Timer(delay, self.flush, [key])
+                pending.timer.start()
+
+        self.update_status()
+
+    def flush(self, key):
+        """Sync everything waiting for destination"""
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None or pending.running or pending.job is None:
+                return
+
+            job = pending.job
+            full = pending.full
+            if full:
+                job.specific_paths = []
+            else:
+                # Files might have been removed again while waiting
+                job.specific_paths = sorted(path for path in pending.paths if os.path.exists(path))
+
+            pending.job = None
+            pending.paths = set()
+            pending.full = False
+            pending.timer = None
+
+            # Nothing left to sync
+            if not full and not job.specific_paths:
+                del self.pending[key]
+                job = None
+            else:
+                pending.running = True
+                pending.current = job
+
+        if job is not None:
+            self.scheduler.submit(job.destination.get("remote_host"), self.run, key, job)
+        self.update_status()
+
+    def run(self, key, job):
+        """Run job and flush changes that arrived while it was running"""
+        with self.lock:
+            self.pending[key].started = True
+        self.update_status()
+
+        try:
+            job.run()
+        finally:
+            with self.lock:
+                pending = self.pending[key]
+                pending.running = False
+                pending.started = False
+                pending.current = None
+                if pending.job is None:
+                    del self.pending[key]
+                else:
+                    pending.timer = threading.Timer(0, self.flush, [key])
+                    pending.timer.start()
+            self.update_status()
+
+    def cancel_all(self):
+        """Drop everything waiting to be synced and cancel the running syncs, returns the number of destinations"""
+        with self.lock:
+            count = len(self.pending)
+            for key, pending in list(self.pending.items()):
+                if pending.timer:
+                    pending.timer.cancel()
+                    pending.timer = None
+                pending.job = None
+                pending.paths = set()
+                pending.full = False
+                if pending.running:
+                    pending.current.cancel()
+                else:
+                    del self.pending[key]
+        self.update_status()
+        return count
+
+    def update_status(self):
+        """Show number of destinations being synced in the status bar"""
+        with self.lock:
+            running = len([pending for pending in self.pending.values() if pending.started])
+            queued = len(self.pending) - running
+            was_busy = self.busy
+            self.busy = bool(running or queued)
+            if not self.busy:
+                self.idle.notify_all()
+
+        if running or queued:
+            status_bar_message = "Rsyncing to " + str(running) + " destination"
+            if running != 1:
+                status_bar_message += "s"
+            if queued:
+                status_bar_message += " (" + str(queued) + " queued"
+                # Syncs ready to go that wait for a free worker, because of the max_workers limits
+                waiting = self.scheduler.queue_depth()
+                if waiting:
+                    status_bar_message += ", " + str(waiting) + " waiting for a worker"
+                status_bar_message += ")"
+            self.reporter.set_status(STATUS_KEY, status_bar_message)
+        elif was_busy:
+            self.reporter.erase_status(STATUS_KEY)
+            self.reporter.status_message("Rsyncing - done.")
+            console_print("", "", "done")
+
+    def wait(self, timeout=None):
+        """Wait until all queued syncs are done, returns False on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+        return True
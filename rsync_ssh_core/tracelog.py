@@ -0,0 +1,147 @@
+"""Trace log of completed syncs, with stage timings and rsync statistics."""
+import collections
+import json
+import os
+import threading
+import time
+
+from .util import build_rsync_destination_string, console_print, percentile
+
+
+class SyncTrace(object):
+    """Trace log of completed syncs, one JSON record per line, rotated when it grows too large"""
+
+    def __init__(self, path, max_size=5000000, keep=3):
+        self.path = path
+        self.max_size = max_size
+        self.keep = keep
+        self.lock = threading.Lock()
+
+    def write(self, job):
+        """Append record for completed job, returns the record"""
+        record = {
+            "time": round(time.time(), 3),
+            "destination": build_rsync_destination_string(job.destination),
+            "host": job.destination.get("remote_host"),
+            "prefix": job.prefix,
+            "paths": len(job.specific_paths),
+            "result": job.result,
+            "latency": round(time.time() - job.queued_at, 4),
+            "stages": job.timings,
+            "stats": job.stats,
+            "decisions": job.decisions,
+        }
+        self.append(record)
+        return record
+
+    def write_hook(self, job, name, result, seconds, coalesced):
+        """Append record for a remote command run after its sync was done, e.g. a debounced post command"""
+        record = {
+            "time": round(time.time(), 3),
+            "destination": build_rsync_destination_string(job.destination),
+            "host": job.destination.get("remote_host"),
+            "prefix": job.prefix,
+            "hook": name,
+            "syncs": coalesced,
+            "result": result,
+            "stages": {name: round(seconds, 4)},
+        }
+        self.append(record)
+        return record
+
+    def append(self, record):
+        """Append record to the trace log"""
+        with self.lock:
+            try:
+                if not os.path.isdir(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                with open(self.path, "a") as trace_file:
+                    trace_file.write(json.dumps(record) + "\n")
+                if os.path.getsize(self.path) > self.max_size:
+                    self.rotate()
+            except (IOError, OSError) as error:
+                console_print("", "", "Unable to write trace log: " + str(error))
+
+    def rotate(self):
+        """Rotate trace files, must be called with the lock held"""
+        for number in range(self.keep - 1, 0, -1):
+            if os.path.exists(self.path + "." + str(number)):
+                os.replace(self.path + "." + str(number), self.path + "." + str(number + 1))
+        os.replace(self.path, self.path + ".1")
+
+    def records(self):
+        """Read all records, oldest first"""
+        paths = [self.path + "." + str(number) for number in range(self.keep, 0, -1)] + [self.path]
+        with self.lock:
+            for path in paths:
+                if not os.path.exists(path):
+                    continue
+                with open(path, "r") as trace_file:
+                    for line in trace_file:
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            continue
+
+    def summary(self):
+        """Summarise latency and stage timings per destination"""
+        destinations = collections.OrderedDict()
+        for record in self.records():
+            if record.get("result") in ("skipped", "cancelled"):
+                continue
+            destinations.setdefault(record.get("destination"), []).append(record)
+
+        lines = []
+        for destination, records in destinations.items():
+            # Remote commands run after their sync was done have a record of their own, only used for the stage timings
+            hooks = [record for record in records if "hook" in record and record.get("result") == "ok"]
+            records = [record for record in records if "hook" not in record]
+            succeeded = [record for record in records if record.get("result") == "ok"]
+            latencies = [record.get("latency", 0) for record in succeeded]
+            lines.append(
+                destination
+                + ": "
+                + str(len(records))
+                + " syncs, "
+                + str(len(records) - len(succeeded))
+                + " failed, latency p50 "
+                + "%.3fs" % percentile(latencies, 50)
+                + " p95 "
+                + "%.3fs" % percentile(latencies, 95)
+            )
+            for stage in ["check", "pre_command", "scan", "transfer", "post_command"]:
+                timings = [record["stages"][stage] for record in succeeded + hooks if stage in record.get("stages", {})]
+                if timings:
+                    lines.append(
+                        "    "
+                        + stage
+                        + ": p50 "
+                        + "%.3fs" % percentile(timings, 50)
+                        + " p95 "
+                        + "%.3fs" % percentile(timings, 95)
+                    )
+            literal = sum(record.get("stats", {}).get("literal_bytes", 0) for record in succeeded)
+            matched = sum(record.get("stats", {}).get("matched_bytes", 0) for record in succeeded)
+            transferred = sum(record.get("stats", {}).get("files_transferred", 0) for record in succeeded)
+            lines.append(
+                "    files transferred: "
+                + str(transferred)
+                + ", literal data: "
+                + str(literal)
+                + " bytes, matched data: "
+                + str(matched)
+                + " bytes"
+            )
+        return lines
+
+
+sync_traces = {}
+sync_traces_lock = threading.Lock()
+
+
+def sync_trace(path):
+    """Get the trace log stored at path, shared by everyone using the same file"""
+    with sync_traces_lock:
+        if path not in sync_traces:
+            sync_traces[path] = SyncTrace(path)
+        return sync_traces[path]
@@ -0,0 +1,196 @@
+"""Helpers shared by the sync engine: process execution, output parsing and destination strings."""
+import collections
+import math
+import os
+import re
+import shlex
+import subprocess
+
+
+def console_format(host, prefix, output):
+    """Format message for console or output panel"""
+    if host and prefix:
+        host = host + "[" + prefix + "]: "
+    elif host and not prefix:
+        host = host + ": "
+    elif not host and prefix:
+        host = os.path.basename(prefix) + ": "
+
+    return "[rsync-ssh] " + host + output.replace("\n", "\n[rsync-ssh] " + host)
+
+
+def console_print(host, prefix, output):
+    """Print message to console"""
+    print(console_format(host, prefix, output))
+
+
+def normalize_path(path):
+    """Normalizes path to Unix format, converting back- to forward-slashes."""
+    return path.strip().replace("\\", "/")
+
+
+def current_user():
+    """Get current username from the environment"""
+    if "USER" in os.environ:
+        return os.environ["USER"]
+    elif "USERNAME" in os.environ:
+        return os.environ["USERNAME"]
+    else:
+        return "username"
+
+
+def is_windows():
+    """Check if we are running on Windows, where rsync and ssh are assumed to be from cygwin"""
+    return os.name == "nt"
+
+
+def startupinfo():
+    """Get startupinfo for subprocesses"""
+    info = None
+    if is_windows():
+        # Don't let console window pop-up on Windows.
+        info = subprocess.STARTUPINFO()
+        info.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        info.wShowWindow = subprocess.SW_HIDE
+    return info
+
+
+def check_output(*args, **kwargs):
+    """Runs specified system command using subprocess.check_output()"""
+    return subprocess.check_output(*args, universal_newlines=True, startupinfo=startupinfo(), **kwargs)
+
+
+def popen(*args, **kwargs):
+    """Starts specified system command using subprocess.Popen()"""
+    return subprocess.Popen(*args, universal_newlines=True, startupinfo=startupinfo(), **kwargs)
+
+
+# Overall progress as reported by --info=progress2, e.g. "  1,234,567  45%   12.34MB/s    0:00:01 (xfr#3, to-chk=10/20)"
+RSYNC_PROGRESS_PATTERN = re.compile(r"^\s*([\d,.]+[KMGT]?)\s+(\d+)%\s+(\S+/s)\s+(\S+)")
+
+
+def stream_output(command, on_line, tail_size=100, on_start=None):
+    """Run command and pass each line of output to on_line as it arrives.
+
+    Only the last tail_size lines are kept, for the CalledProcessError raised if the command fails. Lines for
+    which on_line returns True (e.g. progress updates) are not kept at all. on_start is given the process, so
+    it can be killed by someone else.
+    """
+    process = popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if on_start:
+        on_start(process)
+    tail = collections.deque(maxlen=tail_size)
+
+    # Universal newlines turns the carriage returns used for progress updates into separate lines
+    for line in process.stdout:
+        line = line.rstrip("\n")
+        if not on_line(line):
+            tail.append(line)
+
+    returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command, "\n".join(tail))
+
+
+local_rsync_versions = {}
+
+
+def local_rsync_capabilities(command):
+    """Get capabilities of the local rsync"""
+    if command not in local_rsync_versions:
+        try:
+            local_rsync_versions[command] = parse_rsync_version(check_output([command, "--version"], stderr=subprocess.STDOUT))
+        except (subprocess.CalledProcessError, OSError):
+            local_rsync_versions[command] = parse_rsync_version("")
+    return local_rsync_versions[command]
+
+
+def build_ssh_destination_string(destination):
+    """Build SSH destination string: (user@)host(:port)"""
+
+    user = destination.get("remote_user")
+    host = destination.get("remote_host")
+    port = destination.get("remote_port")
+
+    parts = [
+        user + "@" if user else None,
+        host,
+        ":" + str(port) if port else None,
+    ]
+    return "".join(filter(None, parts))
+
+
+def build_ssh_host_string(destination):
+    """Build SSH host string: (user@)host - the port is passed to ssh using -p"""
+
+    user = destination.get("remote_user")
+    host = destination.get("remote_host")
+
+    return user + "@" + host if user else host
+
+
+def build_rsync_destination_string(destination, path=None):
+    """Build rsync destination string: (user@)host(:port):path - used for identifying destinations"""
+    if path is None:
+        path = destination.get("remote_path")
+    return build_ssh_destination_string(destination) + ":" + shlex.quote(path)
+
+
+def build_rsync_target_string(destination, path=None):
+    """Build rsync target string: (user@)host:path"""
+    if path is None:
+        path = destination.get("remote_path")
+    return build_ssh_host_string(destination) + ":" + shlex.quote(path)
+
+
+def parse_rsync_version(output):
+    """Parse capabilities from the output of rsync --version"""
+    capabilities = {"version": "", "protocol": 0, "compress": ["zlib"]}
+
+    match = re.search(r"rsync\s+version\s+v?(\S+)\s+protocol version (\d+)", output)
+    if match:
+        capabilities["version"] = match.group(1)
+        capabilities["protocol"] = int(match.group(2))
+
+    # rsync 3.2.0 and later lists the supported compression algorithms
+    match = re.search(r"^Compress list:\s*\n\s+(.+)$", output, re.MULTILINE)
+    if match:
+        capabilities["compress"] = [name for name in match.group(1).split() if name != "none"]
+
+    return capabilities
+
+
+# Fields from the output of rsync --stats
+RSYNC_STATS_FIELDS = {
+    "Number of files": "files",
+    "Number of files transferred": "files_transferred",
+    "Number of regular files transferred": "files_transferred",
+    "Total file size": "total_size",
+    "Total transferred file size": "transferred_size",
+    "Literal data": "literal_bytes",
+    "Matched data": "matched_bytes",
+    "Total bytes sent": "bytes_sent",
+    "Total bytes received": "bytes_received",
+}
+RSYNC_STATS_PATTERN = re.compile(r"^(" + "|".join(RSYNC_STATS_FIELDS.keys()) + r"): ([\d,.]+)")
+RSYNC_SPEEDUP_PATTERN = re.compile(r"speedup is ([\d,.]+)")
+
+
+def parse_rsync_stats_line(line, stats):
+    """Parse line from the output of rsync --stats into stats"""
+    match = RSYNC_STATS_PATTERN.match(line)
+    if match:
+        stats[RSYNC_STATS_FIELDS[match.group(1)]] = int(float(match.group(2).replace(",", "")))
+        return
+    match = RSYNC_SPEEDUP_PATTERN.search(line)
+    if match:
+        stats["speedup"] = float(match.group(1).replace(",", ""))
+
+
+def percentile(values, percent):
+    """Get percentile of values using the nearest rank method"""
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = max(1, int(math.ceil(percent / 100.0 * len(values))))
+    return values[rank - 1]
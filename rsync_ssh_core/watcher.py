@@ -0,0 +1,239 @@
+"""Filesystem watcher, syncing changes made outside the editor (e.g. git checkout or a build step)."""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from .excludes import compile_excludes
+from .index import RemoteIndex
+from .util import console_print, normalize_path
+
+# inotify event masks, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+    | IN_EXCL_UNLINK
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """Minimal ctypes binding for the Linux inotify API"""
+
+    libc = None
+
+    def __init__(self):
+        if Inotify.libc is None:
+            Inotify.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1: " + os.strerror(ctypes.get_errno()))
+
+    @staticmethod
+    def available():
+        """Check if inotify is available on this platform"""
+        return sys.platform.startswith("linux") and ctypes.util.find_library("c") is not None
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Watch directory, returns the watch descriptor"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch: " + os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def read(self):
+        """Read pending events, returns list of (wd, mask, name)"""
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as error:
+            if error.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)  # pylint: disable=W0612
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        """Stop watching"""
+        os.close(self.fd)
+
+
+class Watcher(threading.Thread):
+    """Watches the local path of every remote, and syncs changed paths in batches"""
+
+    def __init__(self, engine, config):
+        threading.Thread.__init__(self, name="rsync-ssh-watcher")
+        self.daemon = True
+        self.engine = engine
+        self.config = config
+        self.index = RemoteIndex(config.folders, config.remotes, config.project_file_name)
+        self.delay = config.get("watch_delay", config.get("sync_on_save_delay", 250)) / 1000.0
+        self.inotify = Inotify()
+        try:
+            self.wake_read, self.wake_write = os.pipe()
+        except OSError:
+            self.inotify.close()
+            raise
+        self.stopping = False
+        self.paths_by_wd = {}
+        self.matchers = {}
+        self.changed = set()
+        self.first_change = 0
+        self.last_change = 0
+        self.watch_limit_reached = False
+
+    def excluded(self, path, is_dir):
+        """Check if path is excluded for every destination of every remote containing it"""
+        remotes = self.index.lookup(path)
+        if not remotes:
+            return True
+        for remote in remotes:
+            if remote.local_path not in self.matchers:
+                self.matchers[remote.local_path] = [
+                    compile_excludes(self.config.excludes + list(destination.get("excludes", [])))
+                    for destination in remote.destinations
+                ]
+            relative_path = path[len(remote.local_path) + 1 :]
+            for matcher in self.matchers[remote.local_path]:
+                if not matcher.excluded(relative_path, is_dir):
+                    return False
+        return True
+
+    def watch_tree(self, top):
+        """Watch directory and all its subdirectories, except the excluded ones"""
+        for root, dirs, files in os.walk(top):  # pylint: disable=W0612
+            root = normalize_path(root)
+            try:
+                self.paths_by_wd[self.inotify.add_watch(root)] = root
+            except OSError as error:
+                if error.errno == errno.ENOSPC and not self.watch_limit_reached:
+                    self.watch_limit_reached = True
+                    console_print("", "", "Unable to watch " + root + ", raise fs.inotify.max_user_watches to watch it all.")
+                continue
+            for name in list(dirs):
+                if self.excluded(root + "/" + name, True):
+                    dirs.remove(name)
+
+    def roots(self):
+        """Local paths of all remotes, leaving out those within other remotes"""
+        paths = sorted(set(remote.local_path for remote in self.index.remotes))
+        roots = []
+        for path in paths:
+            if not any(path.startswith(root + "/") for root in roots) and os.path.isdir(path):
+                roots.append(path)
+        return roots
+
+    def run(self):
+        """Watch for changes until stopped"""
+        for root in self.roots():
+            self.watch_tree(root)
+        console_print("", "", "Watching " + str(len(self.paths_by_wd)) + " folders for changes.")
+
+        try:
+            while not self.stopping:
+                timeout = None
+                if self.changed:
+                    timeout = max(0, min(self.last_change + self.delay, self.first_change + self.delay * 10) - time.time())
+                readable = select.select([self.inotify.fd, self.wake_read], [], [], timeout)[0]
+                if self.inotify.fd in readable:
+                    self.handle(self.inotify.read())
+                if self.changed and time.time() >= min(self.last_change + self.delay, self.first_change + self.delay * 10):
+                    self.flush()
+        finally:
+            self.inotify.close()
+            os.close(self.wake_read)
+            os.close(self.wake_write)
+
+    def handle(self, events):
+        """Collect changed paths from events"""
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so we don't know what changed
+                console_print("", "", "Too many changes to keep track of, syncing everything.")
+                self.changed = set()
+                self.change("")
+                continue
+            if mask & IN_IGNORED:
+                self.paths_by_wd.pop(wd, None)
+                continue
+
+            directory = self.paths_by_wd.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory + "/" + name
+            is_dir = bool(mask & IN_ISDIR)
+            if self.excluded(path, is_dir):
+                continue
+
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                # Syncing the folder it was in takes care of the deletion, when --delete is among the options
+                self.change(directory)
+            elif is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path)
+                self.change(path)
+            elif not is_dir:
+                self.change(path)
+
+    def change(self, path):
+        """Add path to the current batch"""
+        now = time.time()
+        if not self.changed:
+            self.first_change = now
+        self.last_change = now
+        self.changed.add(path)
+
+    def flush(self):
+        """Sync current batch, leaving out paths within folders that are synced anyway"""
+        paths = sorted(self.changed, key=lambda path: path.split("/"))
+        self.changed = set()
+        if "" in paths:
+            self.engine.sync(self.config)
+            return
+
+        batch = []
+        for path in paths:
+            if batch and path.startswith(batch[-1] + "/"):
+                continue
+            batch.append(path)
+        self.engine.sync_paths(self.config, batch)
+
+    def stop(self):
+        """Stop watching"""
+        self.stopping = True
+        os.write(self.wake_write, b"x")